@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import heapq
+import logging
+import os
+import sys
+from collections import defaultdict
+
+from common import backfill_schedule, migrate_legacy_queues, purge_orphaned_chats, compact_queues, \
+    iter_chat_memory_usage, migrate_chat_storage
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.getLevelName(os.environ.get('LOG_LEVEL', 'INFO')))
+
+
+def command_backfill_schedule(args):
+    count = backfill_schedule()
+    logging.info(f'Scheduled {count} chats')
+
+
+def command_migrate_queues(args):
+    count = migrate_legacy_queues()
+    logging.info(f'Migrated the queues of {count} chats')
+
+
+def command_migrate_chats(args):
+    count = migrate_chat_storage()
+    logging.info(f'Moved the settings and credentials of {count} chats into hashes')
+
+
+def command_purge_orphans(args):
+    deleted, unscheduled = purge_orphaned_chats(dry_run=args.dry_run)
+    action = 'Would delete' if args.dry_run else 'Deleted'
+    logging.info(f'{action} {deleted} keys of chats without twitter credentials, {unscheduled} of them were scheduled')
+
+
+def command_compact_queues(args):
+    queues, dropped = compact_queues()
+    logging.info(f'Compacted {queues} queues, dropped {dropped} entries that could not be tweeted')
+
+
+def command_report(args):
+    # Only a counter per chat is kept in memory, the keys are streamed
+    keys = defaultdict(int)
+    usage = defaultdict(int)
+    for chat_id, key_usage in iter_chat_memory_usage():
+        keys[chat_id] += 1
+        usage[chat_id] += key_usage
+    if args.top:
+        chat_ids = heapq.nlargest(args.top, usage, key=usage.get)
+    else:
+        chat_ids = sorted(usage, key=usage.get, reverse=True)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['chat_id', 'keys', 'bytes'])
+    for chat_id in chat_ids:
+        writer.writerow([chat_id, keys[chat_id], usage[chat_id]])
+    logging.info(f'{len(usage)} chats use {sum(keys.values())} keys and {sum(usage.values())} bytes')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance tasks for my daily twitter')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('backfill_schedule', help='Build the schedule index from the settings of all chats') \
+        .set_defaults(func=command_backfill_schedule)
+    subparsers.add_parser('migrate_queues', help='Convert queues from the per-index key layout to redis lists') \
+        .set_defaults(func=command_migrate_queues)
+    subparsers.add_parser('migrate_chats', help='Move chat settings and credentials into one hash per chat') \
+        .set_defaults(func=command_migrate_chats)
+
+    purge_parser = subparsers.add_parser('purge_orphans', help='Delete all data of chats without twitter credentials')
+    purge_parser.add_argument('--dry-run', action='store_true', help='Only count what would be deleted')
+    purge_parser.set_defaults(func=command_purge_orphans)
+    subparsers.add_parser('compact_queues', help='Rewrite all queues, dropping entries that can not be tweeted') \
+        .set_defaults(func=command_compact_queues)
+    report_parser = subparsers.add_parser('report', help='Print number of keys and memory usage per chat as CSV')
+    report_parser.add_argument('--top', type=int, default=0, help='Only print the chats using the most memory')
+    report_parser.set_defaults(func=command_report)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of the tweet scheduler. Seeds synthetic chats and runs `tweet.loop` for a number of simulated
+minutes against stand-ins for the external services: fakeredis (or a local redis-server), a stub of the twitter API
+with configurable latency and error rate and a stub telegram bot. Nothing leaves the machine.
+
+    pipenv install --dev
+    pipenv run python benchmark.py --chats 10000 --minutes 10
+    pipenv run python benchmark.py --chats 100000 --redis-url redis://localhost:6379/15 --json
+
+Reports the duration of every minute's loop, redis round trips per post, posting lag percentiles and peak memory.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import threading
+from datetime import datetime, timedelta
+from time import perf_counter, sleep
+from typing import Dict, List, Optional
+
+# Read by the modules under test
+os.environ.setdefault('TWITTER_CLIENT_ID', 'benchmark')
+os.environ.setdefault('TWITTER_CLIENT_SECRET', 'benchmark')
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+import pytz
+import requests
+from pytz import utc
+from redis import ConnectionPool
+
+import common
+import tweet
+from common import CountingConnection, REDIS_ROUND_TRIPS, SCHEDULE_KEY, CHAT_SCHEMA_VERSION, QueueFullError, \
+    enqueue, next_tweet_datetime, serialize_queue_entry, get_timezone
+
+SEED_BATCH_SIZE = 1000
+TIMEZONES = [x for x in pytz.common_timezones if '/' in x]
+
+
+class StubTwitter:
+    """Stands in for the shared HTTP session of common.py and answers status updates like twitter would"""
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._ids = itertools.count(1)
+
+    def request(self, method: str, url: str, data=None, **kwargs) -> requests.Response:
+        sleep(random.uniform(0.5, 1.5) * self.latency)
+        if random.random() < self.error_rate:
+            return self._response(503, {'errors': [{'message': 'Over capacity', 'code': 130}]})
+        status_id = next(self._ids)
+        return self._response(200, {
+            'id': status_id,
+            'id_str': str(status_id),
+            'text': (data or {}).get('status', ''),
+            'user': {'id': 1, 'id_str': '1', 'screen_name': 'benchmark'},
+        })
+
+    @staticmethod
+    def _response(status_code: int, body: dict) -> requests.Response:
+        response = requests.Response()
+        response.status_code = status_code
+        response.encoding = 'utf-8'
+        response._content = json.dumps(body).encode('utf-8')
+        return response
+
+
+class StubBot:
+    """Stands in for the telegram bot of the scheduler"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text: str, **kwargs):
+        sleep(self.latency)
+        with self._lock:
+            self.messages += 1
+
+
+def use_redis(url: Optional[str]):
+    """
+    Points the redis client of common.py, and thereby all scripts, to a local redis-server or to an in-memory fakeredis.
+    Round trips are counted like in production. The database is flushed
+    """
+    if url:
+        pool = ConnectionPool.from_url(url, connection_class=CountingConnection, decode_responses=True)
+    else:
+        import fakeredis
+        pool = fakeredis.FakeRedis(decode_responses=True).connection_pool
+        pool.connection_class = type('CountingFakeConnection', (CountingConnection, pool.connection_class), {})
+    common.get_redis().connection_pool = pool
+    common.get_redis().flushdb()
+
+
+def seed(chats: int, queue_size: int, start: datetime, minutes: int, peak_share: float):
+    """
+    Creates authorized chats with full queues and random timezones. `peak_share` of them are due in the first minute
+    (as if they all chose the default tweet time), the others are spread over the following minutes
+    """
+    pipeline = common.get_redis().pipeline(transaction=False)
+    for chat_id in range(1, chats + 1):
+        tz_name = random.choice(TIMEZONES)
+        offset = 0 if random.random() < peak_share else random.randrange(minutes)
+        local = (start + timedelta(minutes=offset)).astimezone(get_timezone(tz_name))
+        tweet_time = f'{local.hour:02}:{local.minute:02}'
+        pipeline.hset(f'chat:{chat_id}', mapping={
+            'access_token': f'token-{chat_id}',
+            'access_token_secret': f'secret-{chat_id}',
+            'timezone': tz_name,
+            'tweet_time': tweet_time,
+            'version': CHAT_SCHEMA_VERSION,
+        })
+        if queue_size:
+            pipeline.rpush(f'chat:{chat_id}:queue', *(serialize_queue_entry(f'Tweet {i} of chat {chat_id}')
+                                                      for i in range(queue_size)))
+        due_at = next_tweet_datetime(tweet_time, tz_name, start - timedelta(seconds=1))
+        pipeline.zadd(SCHEDULE_KEY, {chat_id: due_at.timestamp()})
+        if chat_id % SEED_BATCH_SIZE == 0:
+            pipeline.execute()
+    pipeline.execute()
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def count_round_trips() -> Dict[str, float]:
+    return {labels[0]: value for labels, value in REDIS_ROUND_TRIPS.samples().items()}
+
+
+def count_posts() -> Dict[str, float]:
+    return {f'{result}:{reason}' if reason else result: value
+            for (result, reason), value in tweet.POSTS.samples().items()}
+
+
+def difference(after: Dict[str, float], before: Dict[str, float]) -> Dict[str, float]:
+    return {key: value - before.get(key, 0) for key, value in after.items() if value - before.get(key, 0)}
+
+
+def run_scheduler(start: datetime, minutes: int) -> dict:
+    """Runs the loop of every simulated minute back to back and measures it"""
+    lags = []
+    lags_lock = threading.Lock()
+    loop_started = [0.0]
+    tweet_next_in_queue = tweet.tweet_next_in_queue
+
+    def measured_tweet_next_in_queue(chat_id, now: datetime, due_at: Optional[float] = None):
+        tweet_next_in_queue(chat_id, now, due_at)
+        # Simulated delay until the run started, plus the real time it took to get to this chat
+        lag = now.timestamp() - (due_at or now.timestamp()) + perf_counter() - loop_started[0]
+        with lags_lock:
+            lags.append(lag)
+
+    tweet.tweet_next_in_queue = measured_tweet_next_in_queue
+    round_trips_before = count_round_trips()
+    posts_before = count_posts()
+    durations = []
+    try:
+        for minute in range(minutes):
+            loop_started[0] = perf_counter()
+            tweet.loop(start + timedelta(minutes=minute))
+            durations.append(perf_counter() - loop_started[0])
+            logging.info(f'Minute {minute}: {durations[-1]:.3f} s')
+    finally:
+        tweet.tweet_next_in_queue = tweet_next_in_queue
+
+    round_trips = difference(count_round_trips(), round_trips_before)
+    posts = difference(count_posts(), posts_before)
+    processed = sum(posts.values())
+    return {
+        'minutes': minutes,
+        'posts': posts,
+        'loop_seconds': {'p50': percentile(durations, 50), 'p95': percentile(durations, 95), 'max': max(durations)},
+        'lag_seconds': {'p50': percentile(lags, 50), 'p95': percentile(lags, 95), 'p99': percentile(lags, 99)},
+        'redis_round_trips': round_trips,
+        'redis_round_trips_per_post': sum(round_trips.values()) / processed if processed else 0.0,
+    }
+
+
+def run_enqueue(chats: int, count: int) -> dict:
+    """Enqueues like the bot does for every message it receives"""
+    round_trips_before = count_round_trips()
+    started = perf_counter()
+    rejected = 0
+    for _ in range(count):
+        try:
+            enqueue(random.randint(1, chats), 'Benchmark tweet')
+        except QueueFullError:
+            rejected += 1
+    duration = perf_counter() - started
+    round_trips = sum(difference(count_round_trips(), round_trips_before).values())
+    return {
+        'messages': count,
+        'rejected': rejected,
+        'per_second': count / duration if duration else 0.0,
+        'redis_round_trips_per_message': round_trips / count if count else 0.0,
+    }
+
+
+def redis_used_memory() -> Optional[int]:
+    try:
+        return int(common.get_redis().info('memory')['used_memory'])
+    except Exception:
+        # Not supported by every fakeredis version
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the tweet scheduler')
+    parser.add_argument('--chats', type=int, default=10000)
+    parser.add_argument('--queue-size', type=int, default=3, help='Tweets queued per chat')
+    parser.add_argument('--minutes', type=int, default=10, help='Simulated minutes the tweet times are spread over')
+    parser.add_argument('--peak-share', type=float, default=0.5, help='Share of chats due in the first minute')
+    parser.add_argument('--twitter-latency', type=float, default=0.05, help='Seconds per twitter request')
+    parser.add_argument('--twitter-error-rate', type=float, default=0.01, help='Share of failing twitter requests')
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help='Seconds per telegram message')
+    parser.add_argument('--enqueue', type=int, default=1000, help='Messages to enqueue after the scheduler ran')
+    parser.add_argument('--redis-url', help='Local redis-server to use instead of fakeredis. It will be flushed!')
+    parser.add_argument('--flush-timeout', type=float, default=60,
+                        help='Seconds to wait for queued telegram messages before reporting')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random number generator')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    use_redis(args.redis_url)
+    common.http_session = StubTwitter(args.twitter_latency, args.twitter_error_rate)
+    bot = StubBot(args.telegram_latency)
+    tweet.telegram_bot = bot
+    tweet.notifier.start()
+
+    start = datetime.now(utc).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    seeding_started = perf_counter()
+    seed(args.chats, args.queue_size, start, args.minutes, args.peak_share)
+    seed_seconds = perf_counter() - seeding_started
+    scheduler = run_scheduler(start, args.minutes)
+    enqueue_results = run_enqueue(args.chats, args.enqueue) if args.enqueue else None
+    # The notifier sends in the background and combines messages to the same chat
+    flushed = tweet.notifier.flush(timeout=args.flush_timeout)
+    results = {
+        'chats': args.chats,
+        'seed_seconds': seed_seconds,
+        'scheduler': scheduler,
+        'enqueue': enqueue_results,
+        'telegram_messages': bot.messages,
+        'telegram_messages_flushed': flushed,
+        # Kilobytes on linux
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'redis_used_memory_bytes': redis_used_memory(),
+    }
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    print(f'Chats: {args.chats}, seeded in {results["seed_seconds"]:.1f} s')
+    print(f'Posts: {", ".join(f"{key}={value:.0f}" for key, value in sorted(scheduler["posts"].items()))}')
+    loop_seconds = scheduler['loop_seconds']
+    print(f'Loop per minute: p50={loop_seconds["p50"]:.3f} s, p95={loop_seconds["p95"]:.3f} s, '
+          f'max={loop_seconds["max"]:.3f} s')
+    print(f'Posting lag: p50={scheduler["lag_seconds"]["p50"]:.1f} s, p95={scheduler["lag_seconds"]["p95"]:.1f} s, '
+          f'p99={scheduler["lag_seconds"]["p99"]:.1f} s')
+    print(f'Redis round trips per post: {scheduler["redis_round_trips_per_post"]:.2f} '
+          f'({", ".join(f"{key}={value:.0f}" for key, value in sorted(scheduler["redis_round_trips"].items()))})')
+    if results['enqueue']:
+        print(f'Enqueue: {results["enqueue"]["per_second"]:.0f} messages/s, '
+              f'{results["enqueue"]["redis_round_trips_per_message"]:.2f} redis round trips per message')
+    print(f'Telegram messages sent: {results["telegram_messages"]}'
+          + ('' if flushed else f' (some still queued after {args.flush_timeout:.0f} s)'))
+    print(f'Peak RSS: {results["peak_rss_bytes"] / 1024 / 1024:.1f} MB')
+    if results['redis_used_memory_bytes'] is not None:
+        print(f'Redis memory: {results["redis_used_memory_bytes"] / 1024 / 1024:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,177 @@
+import json
 import logging
 import os
 import sys
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
+from datetime import datetime, time, timedelta
+from functools import lru_cache, wraps
 from pathlib import Path
+from time import monotonic, perf_counter, sleep
+from typing import TYPE_CHECKING, Callable, Iterator, List, Optional, Set, Tuple, Union
 
-import tweepy
-from redis import Redis
-from telegram.ext import Updater
+import pytz
+from pytz import utc
+from pytz.tzinfo import BaseTzInfo
+from redis import ConnectionPool, Redis
+from redis.connection import Connection
+
+from metrics import Counter, Gauge
+
+if TYPE_CHECKING:
+    # Imported where they are used, short-lived processes like admin.py do not need them
+    import requests
+    import tweepy
 
 TWEET_CHARACTER_LIMIT = 280
 MAX_QUEUE_SIZE = 365
 FILE_STORAGE_PATH = Path('/tmp/my_daily_twitter/')
+DEFAULT_TIMEZONE = 'UTC'
+DEFAULT_TWEET_TIME = '12:00'
+# Sorted set of chat ids, scored by the UTC timestamp of their next tweet
+SCHEDULE_KEY = 'schedule'
+# A claimed chat becomes due again after that many seconds, unless it is rescheduled before (i.e. if the
+# process that claimed it died while posting)
+CHAT_CLAIM_TIMEOUT = 5 * 60
+STATUS_UPDATE_URL = 'https://api.twitter.com/1.1/statuses/update.json'
+TWITTER_CLIENT_CACHE_SIZE = int(os.environ.get('TWITTER_CLIENT_CACHE_SIZE', 10000))
+TWITTER_CLIENT_TTL = 15 * 60
+# Chat ids published here have changed credentials, every process drops their cached twitter clients
+TWITTER_CLIENTS_CHANNEL = 'twitter_clients:invalidate'
+HTTP_POOL_SIZE = 32
+# Buffered parts of albums expire after that many seconds, in case they were never taken
+MEDIA_GROUP_TTL = 60
+# Idle connections are checked with a PING after that many seconds before they are used again
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', 30))
+# Number of keys requested from redis per SCAN call
+SCAN_BATCH_SIZE = 1000
+# Version of the layout of the chat:{id} hashes, stored in their `version` field
+CHAT_SCHEMA_VERSION = 1
+# Fields of the chat:{id} hash that used to be stored in separate keys chat:{id}:{suffix}
+LEGACY_CHAT_KEYS = {
+    'access_token': 'oauth:access_token',
+    'access_token_secret': 'oauth:access_token_secret',
+    'timezone': 'settings:timezone',
+    'tweet_time': 'settings:tweet_time',
+}
+
+# Text and telegram attachment id
+QueueEntry = Tuple[str, Optional[str]]
+# Tweet time and timezone
+ChatSettings = Tuple[Optional[str], Optional[str]]
+# Telegram file id, mime type and size of an attachment
+Attachment = Tuple[str, Optional[str], Optional[int]]
+
+REDIS_ROUND_TRIPS = Counter('redis_round_trips_total', 'Requests sent to redis, by logical operation', ('operation',))
+STARTUP_SECONDS = Gauge('startup_seconds', 'Time from the start of the process until a startup phase was completed',
+                        ('phase',))
+_redis_operation: ContextVar[str] = ContextVar('redis_operation', default='other')
+
+
+class CountingConnection(Connection):
+    """Counts every request (a single command or a whole pipeline) sent to redis"""
+
+    def send_packed_command(self, command, check_health=True):
+        REDIS_ROUND_TRIPS.inc(operation=_redis_operation.get())
+        super().send_packed_command(command, check_health)
+
+
+def redis_operation(name: str) -> Callable:
+    """Attributes the redis requests of the decorated function to the operation `name`, unless it is nested"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _redis_operation.get() != 'other':
+                return func(*args, **kwargs)
+            token = _redis_operation.set(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _redis_operation.reset(token)
+        return wrapper
+    return decorator
+
+
+_redis: Optional[Redis] = None
+_redis_lock = threading.Lock()
+
+
+def get_redis() -> Redis:
+    """Returns the shared redis client. It is created on first use, connections are opened when they are needed"""
+    global _redis
+    if _redis is None:
+        with _redis_lock:
+            if _redis is None:
+                _redis = Redis(connection_pool=ConnectionPool(
+                    connection_class=CountingConnection,
+                    host=os.environ.get('REDIS_HOST', 'redis'),
+                    port=os.environ.get('REDIS_PORT', 6379),
+                    encoding='utf-8',
+                    decode_responses=True,
+                    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+                ))
+    return _redis
+
+
+def _register_script(script: str) -> Callable:
+    """
+    Like `Redis.register_script`, but the script is only registered when it is called first.
+    It always runs on the client returned by `get_redis`, unless another client (e.g. a pipeline) is given
+    """
+    registered = None
+
+    def run(keys=(), args=(), client=None):
+        nonlocal registered
+        if registered is None:
+            registered = get_redis().register_script(script)
+        return registered(keys=keys, args=args, client=get_redis() if client is None else client)
+    return run
+
 
-redis = Redis(
-    host=os.environ.get('REDIS_HOST', 'redis'),
-    port=os.environ.get('REDIS_PORT', 6379),
-    charset='utf-8',
-    decode_responses=True
-)
+# Shared by all twitter requests we send ourselves, so they reuse connections. Created by get_http_session
+http_session: Optional['requests.Session'] = None
+_http_session_lock = threading.Lock()
 
+# chat id -> (expiry, client), least recently used first
+_twitter_clients: 'OrderedDict[str, Tuple[float, tweepy.API]]' = OrderedDict()
+_twitter_clients_lock = threading.Lock()
+_twitter_clients_listener = None
 
-def get_telegram_updater():
-    return Updater(token=os.environ.get('TELEGRAM_TOKEN'), use_context=True)
+
+def get_telegram_updater(**kwargs):
+    # Imported here, it pulls in the job queue and its scheduler, which only the bot needs
+    from telegram.ext import Updater
+    return Updater(token=os.environ.get('TELEGRAM_TOKEN'), use_context=True, **kwargs)
+
+
+def get_telegram_bot(**request_kwargs):
+    """Returns a bot for processes that only send requests to telegram, without receiving updates"""
+    from telegram import Bot
+    from telegram.utils.request import Request
+    return Bot(token=os.environ.get('TELEGRAM_TOKEN'), request=Request(**request_kwargs))
+
+
+def init_sentry():
+    """Sets up error reporting, if SENTRY_DSN is set. Otherwise, sentry is not even imported"""
+    dsn = os.environ.get('SENTRY_DSN')
+    if not dsn:
+        return
+    import sentry_sdk
+    from sentry_sdk.integrations.redis import RedisIntegration
+    from sentry_sdk.integrations.tornado import TornadoIntegration
+    sentry_sdk.init(
+        dsn,
+        traces_sample_rate=float(os.environ.get('SENTRY_TRACES_SAMPLE_RATE', 1.0)),
+        integrations=[RedisIntegration(), TornadoIntegration()],
+    )
+
+
+def report_startup(phase: str, started_at: float):
+    """Logs and exports the time from `started_at` (a `perf_counter` value) until the startup phase was completed"""
+    seconds = perf_counter() - started_at
+    STARTUP_SECONDS.set(seconds, phase=phase)
+    logging.info(f'Startup: {phase} after {seconds:.3f} s')
 
 
 def check_env_variables():
@@ -30,19 +181,693 @@ def check_env_variables():
             return sys.exit(1)
 
 
-def get_twitter_auth():
+@lru_cache(maxsize=None)
+def get_timezone(name: str) -> BaseTzInfo:
+    return pytz.timezone(name)
+
+
+def get_http_session() -> 'requests.Session':
+    global http_session
+    if http_session is None:
+        with _http_session_lock:
+            if http_session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                session.mount('https://', HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE))
+                http_session = session
+    return http_session
+
+
+def get_twitter_auth() -> 'tweepy.OAuthHandler':
+    import tweepy
     return tweepy.OAuthHandler(os.environ['TWITTER_CLIENT_ID'], os.environ['TWITTER_CLIENT_SECRET'])
 
 
-def get_twitter_api(chat_id) -> tweepy.API:
+@redis_operation('get_twitter_api')
+def get_twitter_api(chat_id) -> 'tweepy.API':
+    """Returns a client for the twitter account of the chat. Clients are cached for TWITTER_CLIENT_TTL seconds"""
+    import tweepy
+    _listen_for_twitter_client_invalidations()
+    key = str(chat_id)
+    with _twitter_clients_lock:
+        entry = _twitter_clients.get(key)
+        if entry is not None and entry[0] > monotonic():
+            _twitter_clients.move_to_end(key)
+            return entry[1]
     auth = get_twitter_auth()
-    access_token = redis.get(f'chat:{chat_id}:oauth:access_token')
-    secret = redis.get(f'chat:{chat_id}:oauth:access_token_secret')
+    access_token, secret = _read_script(keys=_chat_keys(chat_id), args=['access_token', 'access_token_secret'])
     auth.set_access_token(access_token, secret)
-    return tweepy.API(auth)
+    api = tweepy.API(auth)
+    with _twitter_clients_lock:
+        _twitter_clients[key] = (monotonic() + TWITTER_CLIENT_TTL, api)
+        _twitter_clients.move_to_end(key)
+        while len(_twitter_clients) > TWITTER_CLIENT_CACHE_SIZE:
+            _twitter_clients.popitem(last=False)
+    return api
+
+
+def invalidate_twitter_api(chat_id):
+    """Drops the cached twitter client of the chat, in this and all other processes"""
+    _drop_twitter_api(chat_id)
+    get_redis().publish(TWITTER_CLIENTS_CHANNEL, chat_id)
+
+
+def _drop_twitter_api(chat_id):
+    with _twitter_clients_lock:
+        _twitter_clients.pop(str(chat_id), None)
+
+
+def _listen_for_twitter_client_invalidations():
+    global _twitter_clients_listener
+    with _twitter_clients_lock:
+        if _twitter_clients_listener is not None:
+            return
+        pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{TWITTER_CLIENTS_CHANNEL: lambda message: _drop_twitter_api(message['data'])})
+        _twitter_clients_listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+
+def twitter_request(auth: 'tweepy.OAuthHandler', method: str, url: str, **kwargs) -> dict:
+    """Sends a request to the twitter API through the shared session and raises TweepErrors like tweepy does"""
+    import requests
+    import tweepy
+    try:
+        response = get_http_session().request(method, url, auth=auth.apply_auth(), timeout=60, **kwargs)
+    except requests.RequestException as e:
+        raise tweepy.TweepError(f'Failed to send request: {e}')
+    if not 200 <= response.status_code < 300:
+        try:
+            error = response.json()['errors'][0]
+            reason, api_code = error['message'], error.get('code')
+        except (ValueError, KeyError, IndexError, TypeError):
+            reason, api_code = f'Twitter error response: status code = {response.status_code}', None
+        if response.status_code == 429:
+            raise tweepy.RateLimitError(reason, response)
+        raise tweepy.TweepError(reason, response, api_code=api_code)
+    return response.json() if response.content else {}
+
+
+def post_status(api: 'tweepy.API', text: str, media_ids: Optional[List[str]] = None) -> 'tweepy.Status':
+    """
+    Equivalent to `api.update_status`, but sent through the shared session
+    (tweepy opens a new session, and therefore a new connection, for every call)
+    """
+    import tweepy
+    data = {'status': text}
+    if media_ids:
+        data['media_ids'] = ','.join(media_ids)
+    return tweepy.Status.parse(api, twitter_request(api.auth, 'POST', STATUS_UPDATE_URL, data=data))
+
+
+class RateLimitGate:
+    """Shared between threads calling the same API; lets them wait while a rate limit reported by the API is active"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocked_until = 0.0
+
+    def block_for(self, seconds: float):
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, monotonic() + seconds)
+
+    def wait(self):
+        delay = self._blocked_until - monotonic()
+        if delay > 0:
+            sleep(delay)
 
 
 def build_tweet_url(status) -> str:
     if status is None:
         return '<no tweet was posted>'
     return f'https://twitter.com/{status.author.screen_name}/status/{status.id}'
+
+
+def next_tweet_datetime(tweet_time: str, tz_name: Optional[str], after: datetime) -> datetime:
+    """
+    Returns the first point in time (in UTC) strictly after `after` at which the local
+    clock of `tz_name` shows `tweet_time`.
+
+    Times skipped by a DST transition are treated as if the clock had not been changed yet,
+    ambiguous times resolve to their second occurrence.
+    """
+    tz = get_timezone(tz_name or DEFAULT_TIMEZONE)
+    hour, minute = (int(x) for x in tweet_time.split(':'))
+    local_date = after.astimezone(tz).date()
+    # Due to DST transitions, the candidate of the following day might still be before `after`
+    for days in range(3):
+        naive = datetime.combine(local_date + timedelta(days=days), time(hour, minute))
+        candidate = tz.normalize(tz.localize(naive, is_dst=False)).astimezone(utc)
+        if candidate > after:
+            return candidate
+    raise ValueError(f'Unable to find next tweet time for {tweet_time} ({tz_name})')
+
+
+# Data access
+#
+# Every logical operation on the state of a chat is a single pipeline or lua script, so it costs one round trip
+# and can not interleave with a concurrent update of the same chat. The only exception is (re-)scheduling:
+# the next tweet time has to be calculated in python, which is why the schedule is only written if the
+# settings it was calculated from are still current.
+#
+# Credentials and settings of a chat are stored in the hash chat:{id} (small hashes are stored compactly by redis),
+# its queue in the list chat:{id}:queue. Chats that still use the legacy layout of one key per field are migrated
+# by the first script that accesses them, see _CHAT_PRELUDE, or all at once with `migrate_chat_storage`.
+
+# Prepended to the scripts that access the chat hash. Expects the chat hash, followed by the legacy keys
+# (in the order of LEGACY_CHAT_KEYS), as the last KEYS. Defines `chat`, the name of the chat hash.
+_CHAT_PRELUDE = """
+local legacy_fields = {%s}
+local chat_index = #KEYS - #legacy_fields
+local chat = KEYS[chat_index]
+local function upgrade_chat()
+    if redis.call('HEXISTS', chat, 'version') == 1 then
+        return 0
+    end
+    local values = redis.call('MGET', unpack(KEYS, chat_index + 1))
+    local upgraded = 0
+    for i, field in ipairs(legacy_fields) do
+        if values[i] then
+            redis.call('HSET', chat, field, values[i])
+            upgraded = 1
+        end
+    end
+    if upgraded == 1 then
+        redis.call('HSET', chat, 'version', '%d')
+        redis.call('DEL', unpack(KEYS, chat_index + 1))
+    end
+    return upgraded
+end
+local upgraded = upgrade_chat()
+""" % (', '.join(f"'{field}'" for field in LEGACY_CHAT_KEYS), CHAT_SCHEMA_VERSION)
+
+
+def _register_chat_script(script: str) -> Callable:
+    return _register_script(_CHAT_PRELUDE + script)
+
+
+def _chat_keys(chat_id) -> List[str]:
+    """The keys expected by _CHAT_PRELUDE"""
+    return [f'chat:{chat_id}'] + [f'chat:{chat_id}:{suffix}' for suffix in LEGACY_CHAT_KEYS.values()]
+
+
+# KEYS: chat keys
+_upgrade_script = _register_chat_script("""
+return upgraded
+""")
+
+# KEYS: chat keys; ARGV: fields
+_read_script = _register_chat_script("""
+return redis.call('HMGET', chat, unpack(ARGV))
+""")
+
+# KEYS: schedule, chat keys; ARGV: chat_id, tweet_time, timezone, score (empty to unschedule)
+_schedule_script = _register_chat_script("""
+local settings = redis.call('HMGET', chat, 'tweet_time', 'timezone')
+if (settings[1] or '') ~= ARGV[2] or (settings[2] or '') ~= ARGV[3] then
+    return 0
+end
+if ARGV[4] == '' then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+else
+    redis.call('ZADD', KEYS[1], ARGV[4], ARGV[1])
+end
+return 1
+""")
+
+# KEYS: schedule, queue, chat keys; ARGV: chat_id, now, claimed until
+_claim_script = _register_chat_script("""
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not score or tonumber(score) > tonumber(ARGV[2]) then
+    return false
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+local settings = redis.call('HMGET', chat, 'tweet_time', 'timezone')
+return {redis.call('LINDEX', KEYS[2], 0) or '', settings[1] or '', settings[2] or ''}
+""")
+
+# KEYS: chat hash, legacy access_token, followed by the keys to delete
+_purge_script = _register_script("""
+if redis.call('HEXISTS', KEYS[1], 'access_token') == 1 or redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+return redis.call('DEL', unpack(KEYS, 3))
+""")
+
+# KEYS: schedule, chat hash, legacy access_token; ARGV: chat id
+_unschedule_orphan_script = _register_script("""
+if redis.call('HEXISTS', KEYS[2], 'access_token') == 1 or redis.call('EXISTS', KEYS[3]) == 1 then
+    return 0
+end
+return redis.call('ZREM', KEYS[1], ARGV[1])
+""")
+
+# KEYS: queue, chat keys; ARGV: maximum queue size, serialized entries
+_enqueue_script = _register_chat_script("""
+if redis.call('HEXISTS', chat, 'access_token') == 0 then
+    return false
+end
+local tweet_time = redis.call('HGET', chat, 'tweet_time')
+local size = redis.call('LLEN', KEYS[1])
+if size + #ARGV - 1 > tonumber(ARGV[1]) then
+    return {size, tweet_time, 0}
+end
+return {redis.call('RPUSH', KEYS[1], unpack(ARGV, 2)), tweet_time, 1}
+""")
+
+# KEYS: chat keys; ARGV: field, value
+_update_setting_script = _register_chat_script("""
+redis.call('HSET', chat, ARGV[1], ARGV[2], 'version', '%d')
+return redis.call('HMGET', chat, 'tweet_time', 'timezone')
+""" % CHAT_SCHEMA_VERSION)
+
+# KEYS: chat keys; ARGV: token, secret, default timezone, default time
+_authorize_script = _register_chat_script("""
+redis.call('HSET', chat, 'access_token', ARGV[1], 'access_token_secret', ARGV[2], 'version', '%d')
+redis.call('HSETNX', chat, 'timezone', ARGV[3])
+redis.call('HSETNX', chat, 'tweet_time', ARGV[4])
+return redis.call('HMGET', chat, 'tweet_time', 'timezone')
+""" % CHAT_SCHEMA_VERSION)
+
+# KEYS: schedule, old queue, new queue, new chat hash, old chat keys; ARGV: old chat_id, new chat_id
+_migrate_script = _register_chat_script("""
+if redis.call('EXISTS', chat) == 1 then
+    redis.call('RENAME', chat, KEYS[4])
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('RENAME', KEYS[2], KEYS[3])
+end
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if score then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('ZADD', KEYS[1], score, ARGV[2])
+end
+""")
+
+
+@redis_operation('get_settings')
+def get_chat_settings(chat_id) -> ChatSettings:
+    """Returns tweet time and timezone of the chat"""
+    return tuple(_read_script(keys=_chat_keys(chat_id), args=['tweet_time', 'timezone']))
+
+
+@redis_operation('schedule')
+def schedule_chat(chat_id, after: Optional[datetime] = None, settings: Optional[ChatSettings] = None,
+                  retry_at: Optional[datetime] = None) -> bool:
+    """
+    Updates the position of the chat in the schedule index, based on its settings (tweet time and timezone).
+    With `retry_at`, the chat is due again at that time instead, unless its next regular tweet time is earlier.
+    Returns False if the settings were changed in the meantime; whoever changed them is responsible for the schedule
+    """
+    tweet_time, tz_name = settings or get_chat_settings(chat_id)
+    score = ''
+    if tweet_time:
+        next_tweet = next_tweet_datetime(tweet_time, tz_name, after or datetime.now(utc))
+        score = min(next_tweet, retry_at or next_tweet).timestamp()
+    return bool(_schedule_script(
+        keys=[SCHEDULE_KEY] + _chat_keys(chat_id),
+        args=[chat_id, tweet_time or '', tz_name or '', score],
+    ))
+
+
+@redis_operation('unschedule')
+def unschedule_chat(chat_id):
+    """Stops tweeting for the chat until it is authorized again"""
+    pipeline = get_redis().pipeline()
+    pipeline.zrem(SCHEDULE_KEY, chat_id)
+    pipeline.hdel(f'chat:{chat_id}', 'failed_attempts')
+    pipeline.execute()
+
+
+@redis_operation('get_due_chats')
+def get_due_chats(now: datetime, since: Optional[datetime] = None,
+                  with_scores: bool = False) -> Union[List[str], List[Tuple[str, float]]]:
+    """
+    Returns the chats that are due at `now`, optionally only those that became due after `since`.
+    With `with_scores`, returns tuples of the chat id and the timestamp it became due at
+    """
+    return get_redis().zrangebyscore(SCHEDULE_KEY, f'({since.timestamp()}' if since else '-inf', now.timestamp(),
+                                     withscores=with_scores)
+
+
+def scan_batches(match: str) -> Iterator[List[str]]:
+    """
+    Iterates over the keys matching `match` in batches, using SCAN. Unlike KEYS, it neither blocks redis
+    nor holds the whole keyspace in memory. A key may be returned more than once, so handle them idempotently
+    """
+    cursor = None
+    while cursor != 0:
+        cursor, keys = get_redis().scan(cursor or 0, match=match, count=SCAN_BATCH_SIZE)
+        if keys:
+            yield keys
+
+
+def _chat_ids_of_keys(keys: List[str], suffixes: Tuple[str, ...]) -> List[str]:
+    """Returns the ids of the chats the keys chat:{id} or chat:{id}:{suffix} belong to, for the given suffixes"""
+    chat_ids = []
+    for key in keys:
+        _, chat_id, suffix = (key.split(':', 2) + [''])[:3]
+        if suffix in suffixes and chat_id not in chat_ids:
+            chat_ids.append(chat_id)
+    return chat_ids
+
+
+@redis_operation('backfill_schedule')
+def backfill_schedule() -> int:
+    """Builds the schedule index from the settings of all chats. Returns the number of scheduled chats"""
+    count = 0
+    for keys in scan_batches('chat:*'):
+        chat_ids = _chat_ids_of_keys(keys, ('', LEGACY_CHAT_KEYS['tweet_time']))
+        pipeline = get_redis().pipeline(transaction=False)
+        for chat_id in chat_ids:
+            _read_script(keys=_chat_keys(chat_id), args=['tweet_time', 'timezone'], client=pipeline)
+        for chat_id, settings in zip(chat_ids, pipeline.execute()):
+            if settings[0]:
+                schedule_chat(chat_id, settings=settings)
+                count += 1
+    return count
+
+
+@redis_operation('migrate_chat_storage')
+def migrate_chat_storage() -> int:
+    """Moves the data of all chats that still use the legacy layout into their hash. Returns the number of chats"""
+    count = 0
+    for keys in scan_batches('chat:*'):
+        chat_ids = _chat_ids_of_keys(keys, tuple(LEGACY_CHAT_KEYS.values()))
+        pipeline = get_redis().pipeline(transaction=False)
+        for chat_id in chat_ids:
+            _upgrade_script(keys=_chat_keys(chat_id), client=pipeline)
+        count += sum(pipeline.execute())
+    return count
+
+
+@redis_operation('update_setting')
+def update_setting(chat_id, name: str, value: str):
+    """Changes a setting (tweet_time or timezone) of the chat and reschedules it accordingly"""
+    settings = _update_setting_script(keys=_chat_keys(chat_id), args=[name, value])
+    schedule_chat(chat_id, settings=settings)
+
+
+@redis_operation('authorize')
+def authorize_chat(chat_id, access_token: str, access_token_secret: str) -> Tuple[str, str]:
+    """
+    Stores the twitter credentials of the chat, applies default settings if necessary and schedules it.
+    Returns tweet time and timezone of the chat
+    """
+    settings = _authorize_script(
+        keys=_chat_keys(chat_id),
+        args=[access_token, access_token_secret, DEFAULT_TIMEZONE, DEFAULT_TWEET_TIME],
+    )
+    invalidate_twitter_api(chat_id)
+    schedule_chat(chat_id, settings=settings)
+    return tuple(settings)
+
+
+@redis_operation('migrate')
+def migrate_chat(old_chat_id, new_chat_id):
+    """Moves all data of a chat to a new chat id, e.g. when a group is converted to a supergroup"""
+    _migrate_script(
+        keys=[SCHEDULE_KEY, f'chat:{old_chat_id}:queue', f'chat:{new_chat_id}:queue', f'chat:{new_chat_id}']
+             + _chat_keys(old_chat_id),
+        args=[old_chat_id, new_chat_id],
+    )
+    # Keys that are not part of the current layout, e.g. queues that were not migrated yet
+    for keys in scan_batches(f'chat:{old_chat_id}:*'):
+        pipeline = get_redis().pipeline(transaction=False)
+        for key in keys:
+            pipeline.renamenx(key, f'chat:{new_chat_id}:{key.split(":", 2)[2]}')
+        # Fails for keys returned twice by SCAN, which were renamed already
+        pipeline.execute(raise_on_error=False)
+    invalidate_twitter_api(old_chat_id)
+    invalidate_twitter_api(new_chat_id)
+
+
+def serialize_queue_entry(text: str, tg_attachment_id: Optional[str] = None) -> str:
+    entry = {'text': text}
+    if tg_attachment_id:
+        entry['tg_attachment_id'] = tg_attachment_id
+    return json.dumps(entry, separators=(',', ':'), ensure_ascii=False)
+
+
+def deserialize_queue_entry(raw: Optional[str]) -> Optional[Tuple[str, Optional[str]]]:
+    """Returns the text and telegram attachment id of a queue entry, or None if there is no entry"""
+    if raw is None:
+        return None
+    entry = json.loads(raw)
+    return entry['text'], entry.get('tg_attachment_id')
+
+
+class QueueFullError(Exception):
+    """The entries would not fit into the queue, which holds at most MAX_QUEUE_SIZE entries"""
+
+    def __init__(self, queue_size: int):
+        super().__init__(f'The queue already contains {queue_size} entries')
+        self.queue_size = queue_size
+
+
+def enqueue(chat_id, text: str, tg_attachment_id: Optional[str] = None) -> Optional[Tuple[int, str]]:
+    """
+    Appends an entry to the queue of the chat.
+    Returns the new queue size and the tweet time of the chat, or None if the chat is not authorized yet.
+    Raises QueueFullError if the queue is full
+    """
+    return enqueue_many(chat_id, [(text, tg_attachment_id)])
+
+
+@redis_operation('enqueue')
+def enqueue_many(chat_id, entries: List[QueueEntry]) -> Optional[Tuple[int, str]]:
+    """Like `enqueue`, but appends all entries at once: either all of them end up in the queue, or none"""
+    result = _enqueue_script(
+        keys=[f'chat:{chat_id}:queue'] + _chat_keys(chat_id),
+        args=[MAX_QUEUE_SIZE] + [serialize_queue_entry(text, tg_attachment_id) for text, tg_attachment_id in entries],
+    )
+    if result is None:
+        return None
+    queue_size, tweet_time, added = result
+    if not added:
+        raise QueueFullError(queue_size)
+    return queue_size, tweet_time
+
+
+@redis_operation('buffer_media_group')
+def buffer_media_group_part(media_group_id: str, message_id: int, text: str,
+                            attachment: Optional[Attachment]) -> bool:
+    """
+    Stores a part of an album until all of its parts arrived, each part is sent as a separate message.
+    Returns True for the first part
+    """
+    key = f'media_group:{media_group_id}'
+    pipeline = get_redis().pipeline()
+    pipeline.rpush(key, json.dumps([message_id, text, attachment], separators=(',', ':'), ensure_ascii=False))
+    pipeline.expire(key, MEDIA_GROUP_TTL)
+    parts, _ = pipeline.execute()
+    return parts == 1
+
+
+@redis_operation('take_media_group')
+def take_media_group(media_group_id: str) -> List[Tuple[str, Optional[Attachment]]]:
+    """Removes the buffered parts of an album and returns their text and attachment, in the order of the album"""
+    key = f'media_group:{media_group_id}'
+    pipeline = get_redis().pipeline()
+    pipeline.lrange(key, 0, -1)
+    pipeline.delete(key)
+    raw_parts, _ = pipeline.execute()
+    parts = sorted(json.loads(raw) for raw in raw_parts)
+    return [(text, tuple(attachment) if attachment else None) for _, text, attachment in parts]
+
+
+@redis_operation('claim')
+def claim_due_chat(chat_id, now: datetime) -> Optional[Tuple[Optional[str], ChatSettings]]:
+    """
+    Claims a chat that is due at `now` by moving it CHAT_CLAIM_TIMEOUT seconds into the future (counted from the
+    actual time, `now` may be long gone if the chat waited for a worker), so no other run - of this or any other
+    process - picks it up while it is posted. Returns None if the chat is not due (anymore), i.e. someone else claimed
+    it first. Otherwise, returns the serialized head of its queue and its settings; reschedule the chat with them
+    when done: `schedule_chat(chat_id, after=now, settings=settings)`
+    """
+    claimed_until = max(now, datetime.now(utc)) + timedelta(seconds=CHAT_CLAIM_TIMEOUT)
+    result = _claim_script(
+        keys=[SCHEDULE_KEY, f'chat:{chat_id}:queue'] + _chat_keys(chat_id),
+        args=[chat_id, now.timestamp(), claimed_until.timestamp()],
+    )
+    if result is None:
+        return None
+    head, tweet_time, tz_name = (x or None for x in result)
+    return head, (tweet_time, tz_name)
+
+
+@redis_operation('get_queue_heads')
+def get_queue_heads(chat_ids: List[str]) -> List[Optional[Tuple[str, Optional[str]]]]:
+    pipeline = get_redis().pipeline(transaction=False)
+    for chat_id in chat_ids:
+        pipeline.lindex(f'chat:{chat_id}:queue', 0)
+    return [deserialize_queue_entry(head) for head in pipeline.execute()]
+
+
+@redis_operation('dequeue')
+def dequeue_after_post(chat_id) -> int:
+    """Removes the head of the queue after it was posted and returns the remaining queue size"""
+    pipeline = get_redis().pipeline()
+    pipeline.lpop(f'chat:{chat_id}:queue')
+    pipeline.llen(f'chat:{chat_id}:queue')
+    pipeline.hdel(f'chat:{chat_id}', 'failed_attempts')
+    return pipeline.execute()[1]
+
+
+@redis_operation('count_failed_attempt')
+def count_failed_attempt(chat_id) -> int:
+    """Records a failed attempt to post the head of the queue and returns the number of consecutive failures"""
+    return get_redis().hincrby(f'chat:{chat_id}', 'failed_attempts', 1)
+
+
+@redis_operation('reset_failed_attempts')
+def reset_failed_attempts(chat_id):
+    get_redis().hdel(f'chat:{chat_id}', 'failed_attempts')
+
+
+@redis_operation('delete_last')
+def pop_queue_tail(chat_id) -> Optional[Tuple[str, Optional[str]]]:
+    return deserialize_queue_entry(get_redis().rpop(f'chat:{chat_id}:queue'))
+
+
+@redis_operation('migrate_legacy_queue')
+def migrate_legacy_queue(chat_id) -> int:
+    """
+    Converts the queue of a chat from the old chat:{id}:queue:{i}:text / :tg_attachment_id layout
+    with its separate queue_size counter to the list based queue. The legacy entries are older than
+    anything enqueued since the upgrade, so they are put in front of the list.
+    Returns the number of migrated entries
+    """
+    size_key = f'chat:{chat_id}:queue_size'
+    migrated = 0
+
+    def migrate(pipeline):
+        nonlocal migrated
+        queue_size = int(pipeline.get(size_key) or 0)
+        legacy_keys = []
+        for i in range(queue_size):
+            legacy_keys += [f'chat:{chat_id}:queue:{i}:text', f'chat:{chat_id}:queue:{i}:tg_attachment_id']
+        values = pipeline.mget(legacy_keys) if legacy_keys else []
+        entries = [serialize_queue_entry(values[i] or '', values[i + 1]) for i in range(0, len(values), 2)]
+        pipeline.multi()
+        if entries:
+            pipeline.lpush(f'chat:{chat_id}:queue', *reversed(entries))
+            pipeline.delete(*legacy_keys)
+        pipeline.delete(size_key)
+        migrated = len(entries)
+
+    # Retries if another process migrates the same queue at the same time, so no entry is added twice
+    get_redis().transaction(migrate, size_key)
+    return migrated
+
+
+def migrate_legacy_queues() -> int:
+    """Migrates the queues of all chats that still use the old layout. Returns the number of migrated chats"""
+    count = 0
+    for key in get_redis().scan_iter(match='chat:*:queue_size', count=SCAN_BATCH_SIZE):
+        chat_id = key.split(':')[1]
+        logging.info(f'Migrated {migrate_legacy_queue(chat_id)} queue entries of chat {chat_id}')
+        count += 1
+    return count
+
+
+def _chats_without_credentials(chat_ids: List[str]) -> Set[str]:
+    pipeline = get_redis().pipeline(transaction=False)
+    for chat_id in chat_ids:
+        pipeline.hexists(f'chat:{chat_id}', 'access_token')
+        pipeline.exists(f'chat:{chat_id}:{LEGACY_CHAT_KEYS["access_token"]}')
+    results = pipeline.execute()
+    return {chat_id for i, chat_id in enumerate(chat_ids) if not results[2 * i] and not results[2 * i + 1]}
+
+
+@redis_operation('purge_orphaned_chats')
+def purge_orphaned_chats(dry_run: bool = False) -> Tuple[int, int]:
+    """
+    Deletes the keys of all chats without twitter credentials, e.g. of chats that were never authorized,
+    and removes them from the schedule. Returns the number of deleted keys and unscheduled chats
+    """
+    deleted = 0
+    for keys in scan_batches('chat:*'):
+        keys_by_chat = {}
+        for key in keys:
+            keys_by_chat.setdefault(key.split(':')[1], []).append(key)
+        orphans = _chats_without_credentials(list(keys_by_chat))
+        if dry_run:
+            deleted += sum(len(keys_by_chat[chat_id]) for chat_id in orphans)
+            continue
+        pipeline = get_redis().pipeline(transaction=False)
+        for chat_id in orphans:
+            # Checks the credentials again, in case the chat was authorized in the meantime
+            _purge_script(keys=[f'chat:{chat_id}', f'chat:{chat_id}:{LEGACY_CHAT_KEYS["access_token"]}']
+                          + keys_by_chat[chat_id], client=pipeline)
+        deleted += sum(pipeline.execute())
+
+    unscheduled = 0
+    cursor = None
+    while cursor != 0:
+        cursor, members = get_redis().zscan(SCHEDULE_KEY, cursor or 0, count=SCAN_BATCH_SIZE)
+        orphans = _chats_without_credentials([chat_id for chat_id, _ in members])
+        if dry_run or not orphans:
+            unscheduled += len(orphans)
+            continue
+        pipeline = get_redis().pipeline(transaction=False)
+        for chat_id in orphans:
+            # Like above, in case the chat was authorized in the meantime
+            _unschedule_orphan_script(keys=[SCHEDULE_KEY, f'chat:{chat_id}',
+                                            f'chat:{chat_id}:{LEGACY_CHAT_KEYS["access_token"]}'],
+                                      args=[chat_id], client=pipeline)
+        unscheduled += sum(pipeline.execute())
+    return deleted, unscheduled
+
+
+@redis_operation('compact_queue')
+def compact_queue(chat_id) -> int:
+    """
+    Rewrites the queue of a chat in the current entry format, without entries that can not be tweeted
+    (unreadable, or neither text nor attachment). Returns the number of dropped entries
+    """
+    key = f'chat:{chat_id}:queue'
+    dropped = 0
+
+    def rewrite(pipeline):
+        nonlocal dropped
+        raw_entries = pipeline.lrange(key, 0, -1)
+        entries = []
+        for raw in raw_entries:
+            try:
+                text, tg_attachment_id = deserialize_queue_entry(raw)
+            except (ValueError, KeyError, TypeError):
+                continue
+            if text or tg_attachment_id:
+                entries.append(serialize_queue_entry(text, tg_attachment_id))
+        dropped = len(raw_entries) - len(entries)
+        if entries == raw_entries:
+            return
+        pipeline.multi()
+        pipeline.delete(key)
+        if entries:
+            pipeline.rpush(key, *entries)
+
+    # Retries if the queue is changed while it is rewritten
+    get_redis().transaction(rewrite, key)
+    return dropped
+
+
+def compact_queues() -> Tuple[int, int]:
+    """Compacts the queues of all chats. Returns the number of queues and of dropped entries"""
+    queues = dropped = 0
+    for keys in scan_batches('chat:*:queue'):
+        for key in keys:
+            dropped += compact_queue(key.split(':')[1])
+            queues += 1
+    return queues, dropped
+
+
+def iter_chat_memory_usage() -> Iterator[Tuple[str, int]]:
+    """Yields the chat id and the memory used (in bytes) of every key belonging to a chat"""
+    for keys in scan_batches('chat:*'):
+        pipeline = get_redis().pipeline(transaction=False)
+        for key in keys:
+            pipeline.memory_usage(key)
+        for key, usage in zip(keys, pipeline.execute()):
+            yield key.split(':')[1], usage or 0
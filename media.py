@@ -0,0 +1,306 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Callable, Dict, Iterator, Optional, Set, Tuple
+
+import tweepy
+
+from common import get_redis, get_http_session, twitter_request
+from metrics import Counter, Histogram
+
+# Default upper limit of the disk space used by cached attachments
+MEDIA_CACHE_SIZE = int(os.environ.get('MEDIA_CACHE_SIZE', 512 * 1024 * 1024))
+PARTIAL_DOWNLOAD_SUFFIX = '.part'
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Bots can not download files larger than that from telegram
+TELEGRAM_MAX_DOWNLOAD_SIZE = 20 * 1024 * 1024
+UPLOAD_URL = 'https://upload.twitter.com/1.1/media/upload.json'
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+UPLOAD_CHUNK_RETRIES = 3
+# Maximum time to wait for twitter to process a video or GIF. Well below common.CHAT_CLAIM_TIMEOUT, as the chat
+# could be claimed again by another instance once it is exceeded
+MEDIA_PROCESSING_TIMEOUT = 120
+# Media types twitter accepts, with their upload category and maximum size in bytes
+MEDIA_TYPES = {
+    'image/jpeg': ('tweet_image', 5 * 1024 * 1024),
+    'image/png': ('tweet_image', 5 * 1024 * 1024),
+    'image/webp': ('tweet_image', 5 * 1024 * 1024),
+    'image/gif': ('tweet_gif', 15 * 1024 * 1024),
+    'video/mp4': ('tweet_video', 512 * 1024 * 1024),
+}
+
+DOWNLOADED_BYTES = Counter('media_downloaded_bytes_total', 'Bytes of attachments downloaded from telegram')
+DOWNLOAD_DURATION = Histogram('media_download_duration_seconds', 'Time needed to download an attachment')
+UPLOADED_BYTES = Counter('media_uploaded_bytes_total', 'Bytes of attachments uploaded to twitter')
+UPLOAD_DURATION = Histogram('media_upload_duration_seconds', 'Time needed to upload and process an attachment')
+
+
+class MediaRejectedError(tweepy.TweepError):
+    """Twitter can not use the attachment. Unlike most TweepErrors, retrying does not help"""
+
+
+class MediaProcessingTimeoutError(tweepy.TweepError):
+    """Twitter is still processing the attachment. The upload is resumed by the next attempt"""
+
+
+class MediaCache:
+    """
+    Size bounded cache of telegram attachments on the local disk, keyed by their file id.
+    When the cache is full, the least recently used files are evicted; files that are
+    currently checked out are never evicted.
+    """
+
+    def __init__(self, path: Path, download: Callable[[str, Path], None], max_size: int = MEDIA_CACHE_SIZE):
+        """`download` is called with a file id and the path it has to store the file at"""
+        self.path = path
+        self.max_size = max_size
+        self._download = download
+        self._lock = threading.Lock()
+        # file id -> size in bytes, least recently used first
+        self._entries: 'OrderedDict[str, int]' = OrderedDict()
+        self._pinned: Dict[str, int] = {}
+        # Files that were discarded while they were checked out, they are removed once they are returned
+        self._discarded: Set[str] = set()
+        # file id -> lock held while the file is fetched, number of threads using the lock
+        self._file_locks: Dict[str, Tuple[threading.Lock, int]] = {}
+
+    def cleanup(self):
+        """
+        Removes partial downloads left behind by a previous process and adopts complete files
+        as cache entries, oldest first. Must be called before the cache is used
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        files = []
+        for file in self.path.iterdir():
+            if not file.is_file() or file.name.endswith(PARTIAL_DOWNLOAD_SUFFIX):
+                logging.info(f'Removing orphaned file {file}')
+                file.unlink(missing_ok=True)
+                continue
+            stat = file.stat()
+            files.append((stat.st_mtime, file.name, stat.st_size))
+        with self._lock:
+            for _, file_id, size in sorted(files):
+                self._entries[file_id] = size
+            self._evict()
+        logging.info(f'Media cache contains {len(self._entries)} files ({self.size} bytes)')
+
+    @property
+    def size(self) -> int:
+        return sum(self._entries.values())
+
+    def __contains__(self, file_id: str) -> bool:
+        return file_id in self._entries
+
+    def fetch(self, file_id: str) -> Path:
+        """Makes sure the file is in the cache and returns its path"""
+        with self._lock:
+            file_lock, users = self._file_locks.get(file_id) or (threading.Lock(), 0)
+            self._file_locks[file_id] = (file_lock, users + 1)
+        try:
+            # Prevents downloading the same file twice, e.g. by the prefetcher and a post at the same time
+            with file_lock:
+                return self._fetch(file_id)
+        finally:
+            # Also if the download failed, the lock is only needed while someone uses it
+            with self._lock:
+                file_lock, users = self._file_locks[file_id]
+                if users > 1:
+                    self._file_locks[file_id] = (file_lock, users - 1)
+                else:
+                    del self._file_locks[file_id]
+
+    def _fetch(self, file_id: str) -> Path:
+        """Expects the lock of the file to be held"""
+        filename = self.path / file_id
+        with self._lock:
+            if file_id in self._entries:
+                self._entries.move_to_end(file_id)
+                return filename
+        partial = filename.with_name(filename.name + PARTIAL_DOWNLOAD_SUFFIX)
+        try:
+            self._download(file_id, partial)
+            partial.rename(filename)
+        finally:
+            partial.unlink(missing_ok=True)
+        with self._lock:
+            self._entries[file_id] = filename.stat().st_size
+            self._evict()
+        return filename
+
+    @contextmanager
+    def checkout(self, file_id: str) -> Iterator[Path]:
+        """Fetches the file and protects it from eviction while the context is active"""
+        with self._lock:
+            self._pinned[file_id] = self._pinned.get(file_id, 0) + 1
+        try:
+            yield self.fetch(file_id)
+        finally:
+            with self._lock:
+                self._pinned[file_id] -= 1
+                if not self._pinned[file_id]:
+                    del self._pinned[file_id]
+                    if file_id in self._discarded:
+                        self._discarded.remove(file_id)
+                        self._remove(file_id)
+
+    def discard(self, file_id: str):
+        """
+        Removes a file that will not be needed anymore, e.g. because it was posted. If it is checked out
+        (by another chat that queued the same file), it is removed once it is returned
+        """
+        with self._lock:
+            if file_id in self._pinned:
+                self._discarded.add(file_id)
+            else:
+                self._remove(file_id)
+
+    def _remove(self, file_id: str):
+        """Expects self._lock to be held"""
+        if self._entries.pop(file_id, None) is not None:
+            (self.path / file_id).unlink(missing_ok=True)
+
+    def _evict(self):
+        """Expects self._lock to be held"""
+        size = self.size
+        for file_id in list(self._entries):
+            if size <= self.max_size:
+                break
+            if file_id in self._pinned:
+                continue
+            logging.debug(f'Evicting {file_id} from media cache')
+            size -= self._entries.pop(file_id)
+            (self.path / file_id).unlink(missing_ok=True)
+
+
+def validate_attachment(mime_type: Optional[str], file_size: Optional[int]) -> Optional[str]:
+    """Returns the reason why the attachment can not be tweeted, or None if it is fine"""
+    if mime_type not in MEDIA_TYPES:
+        return f'Sorry, I can only tweet {", ".join(MEDIA_TYPES)} files.'
+    max_size = min(MEDIA_TYPES[mime_type][1], TELEGRAM_MAX_DOWNLOAD_SIZE)
+    if file_size is not None and file_size > max_size:
+        return f'Sorry, this file is too large. It may not exceed {max_size // 1024 // 1024} MB.'
+    return None
+
+
+def guess_media_type(filename: Path) -> Optional[str]:
+    """Determines the media type of a file by its magic number"""
+    with open(filename, 'rb') as f:
+        header = f.read(12)
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if header.startswith(b'\x89PNG'):
+        return 'image/png'
+    if header.startswith(b'GIF8'):
+        return 'image/gif'
+    if header.startswith(b'RIFF') and header[8:12] == b'WEBP':
+        return 'image/webp'
+    if header[4:8] == b'ftyp':
+        return 'video/mp4'
+    return None
+
+
+def download_file(url: str, filename: Path):
+    """Streams a file to disk, without keeping it in memory"""
+    with DOWNLOAD_DURATION.time(), get_http_session().get(url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        with open(filename, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                DOWNLOADED_BYTES.inc(len(chunk))
+
+
+def upload_media(auth: tweepy.OAuthHandler, chat_id, file_id: str, filename: Path) -> str:
+    """
+    Uploads a file with twitters chunked media upload (INIT/APPEND/FINALIZE) and returns its media id.
+
+    The progress is stored in redis, keyed by the chat (a media id can only be used by the account that uploaded it)
+    and the telegram file id: if an upload fails, calling this function again resumes it with the first segment that
+    was not appended yet, and a finalized upload is not repeated until twitter expires it.
+    Call `forget_upload` once the media was posted.
+    """
+    with UPLOAD_DURATION.time():
+        return _upload_media(auth, chat_id, file_id, filename)
+
+
+def _upload_media(auth: tweepy.OAuthHandler, chat_id, file_id: str, filename: Path) -> str:
+    key = f'media_upload:{chat_id}:{file_id}'
+    state = get_redis().hgetall(key)
+    if state.get('finalized'):
+        return state['media_id']
+    media_type = guess_media_type(filename)
+    if media_type not in MEDIA_TYPES:
+        raise MediaRejectedError(f'Unsupported media type: {media_type}')
+    total_bytes = filename.stat().st_size
+    if not state:
+        init = twitter_request(auth, 'POST', UPLOAD_URL, data={
+            'command': 'INIT',
+            'total_bytes': total_bytes,
+            'media_type': media_type,
+            'media_category': MEDIA_TYPES[media_type][0],
+        })
+        state = {'media_id': init['media_id_string'], 'segment': 0}
+        pipeline = get_redis().pipeline()
+        pipeline.hset(key, mapping=state)
+        pipeline.expire(key, init.get('expires_after_secs', 24 * 60 * 60))
+        pipeline.execute()
+    media_id = state['media_id']
+    segment = int(state['segment'])
+    if segment:
+        logging.info(f'Resuming upload of {file_id} with segment {segment}')
+
+    with open(filename, 'rb') as f:
+        f.seek(segment * UPLOAD_CHUNK_SIZE)
+        while f.tell() < total_bytes:
+            chunk = f.read(UPLOAD_CHUNK_SIZE)
+            for attempt in range(UPLOAD_CHUNK_RETRIES):
+                try:
+                    twitter_request(auth, 'POST', UPLOAD_URL, data={
+                        'command': 'APPEND',
+                        'media_id': media_id,
+                        'segment_index': segment,
+                    }, files={'media': chunk})
+                    break
+                except tweepy.RateLimitError:
+                    raise
+                except tweepy.TweepError:
+                    if attempt + 1 == UPLOAD_CHUNK_RETRIES:
+                        raise
+                    logging.warning(f'Unable to append segment {segment} of {file_id}, retrying')
+                    sleep(2 ** attempt)
+            UPLOADED_BYTES.inc(len(chunk))
+            segment += 1
+            get_redis().hset(key, 'segment', segment)
+
+    if state.get('processing'):
+        # Finalized by a previous attempt, which gave up waiting for the processing
+        status = twitter_request(auth, 'GET', UPLOAD_URL, params={'command': 'STATUS', 'media_id': media_id})
+        processing_info = status.get('processing_info')
+    else:
+        finalize = twitter_request(auth, 'POST', UPLOAD_URL, data={'command': 'FINALIZE', 'media_id': media_id})
+        processing_info = finalize.get('processing_info')
+        if processing_info:
+            get_redis().hset(key, 'processing', 1)
+    # Videos and GIFs are processed asynchronously
+    deadline = monotonic() + MEDIA_PROCESSING_TIMEOUT
+    while processing_info and processing_info['state'] in ('pending', 'in_progress'):
+        check_after = processing_info.get('check_after_secs', 1)
+        if monotonic() + check_after > deadline:
+            raise MediaProcessingTimeoutError(f'Twitter did not process the attachment within '
+                                              f'{MEDIA_PROCESSING_TIMEOUT} seconds')
+        sleep(check_after)
+        status = twitter_request(auth, 'GET', UPLOAD_URL, params={'command': 'STATUS', 'media_id': media_id})
+        processing_info = status.get('processing_info')
+    if processing_info and processing_info['state'] == 'failed':
+        # The media id is unusable, so start over the next time
+        get_redis().delete(key)
+        raise MediaRejectedError(processing_info.get('error', {}).get('message', 'Media processing failed'))
+    get_redis().hset(key, 'finalized', 1)
+    return media_id
+
+
+def forget_upload(chat_id, file_id: str):
+    get_redis().delete(f'media_upload:{chat_id}:{file_id}')
@@ -0,0 +1,140 @@
+"""
+Outbound telegram messages of the tweet scheduler. They are sent by a background thread, so posting never waits
+for telegram: messages to the same chat that are queued in quick succession are combined into one, and all
+messages are sent within telegram's flood limits.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Callable, List, Optional, Tuple
+
+from telegram.error import RetryAfter, TelegramError
+
+from common import RateLimitGate
+from metrics import Counter, Gauge
+
+# See https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_MESSAGES_PER_SECOND = 30
+# Messages wait that long for further messages to the same chat, so each chat gets at most one message per interval
+CHAT_MESSAGE_INTERVAL = 1.0
+TELEGRAM_MESSAGE_LIMIT = 4096
+MESSAGE_SEPARATOR = '\n\n'
+
+MESSAGES = Counter('telegram_messages_total', 'Messages sent by the notifier, by result', ('result',))
+PENDING_CHATS = Gauge('telegram_pending_chats', 'Number of chats with messages waiting to be sent')
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, and bursts of up to `capacity` events. Not thread safe"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = monotonic()
+
+    def take(self) -> float:
+        """Takes a token if one is available and returns 0. Otherwise, returns the seconds until one is available"""
+        now = monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+
+def combine(texts: List[str]) -> Tuple[str, List[str]]:
+    """Joins as many messages as fit into a single telegram message. Returns it and the messages that did not fit"""
+    text = texts[0]
+    for i, next_text in enumerate(texts[1:], 1):
+        if len(text) + len(MESSAGE_SEPARATOR) + len(next_text) > TELEGRAM_MESSAGE_LIMIT:
+            return text, texts[i:]
+        text += MESSAGE_SEPARATOR + next_text
+    return text, []
+
+
+class Notifier:
+    """
+    Queues messages to chats and sends them in the background. `send` is called with a chat id and a text, it may
+    raise RetryAfter to pause all messages. The messages are kept in memory; call `flush` before shutting down
+    """
+
+    def __init__(self, send: Callable[[object, str], None], gate: Optional[RateLimitGate] = None):
+        self._send = send
+        self._gate = gate or RateLimitGate()
+        self._bucket = TokenBucket(GLOBAL_MESSAGES_PER_SECOND, GLOBAL_MESSAGES_PER_SECOND)
+        self._condition = threading.Condition()
+        # chat id -> (time its messages may be sent at, messages). Ordered by that time, as it only increases
+        self._pending: 'OrderedDict[object, Tuple[float, List[str]]]' = OrderedDict()
+        self._sending = False
+
+    def start(self):
+        threading.Thread(target=self._run, name='notifier', daemon=True).start()
+
+    def send(self, chat_id, text: str):
+        """Queues a message and returns immediately"""
+        with self._condition:
+            if chat_id in self._pending:
+                self._pending[chat_id][1].append(text)
+            else:
+                self._pending[chat_id] = (monotonic() + CHAT_MESSAGE_INTERVAL, [text])
+            self._condition.notify_all()
+
+    def flush(self, timeout: float) -> bool:
+        """Waits until all queued messages were sent, but at most `timeout` seconds. Returns False on timeout"""
+        deadline = monotonic() + timeout
+        with self._condition:
+            while self._pending or self._sending:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def _next(self) -> Tuple[object, List[str]]:
+        """Waits until the chat that has waited the longest may be sent a message, and takes its messages"""
+        with self._condition:
+            while True:
+                PENDING_CHATS.set(len(self._pending))
+                if not self._pending:
+                    self._condition.wait()
+                    continue
+                chat_id, (ready_at, texts) = next(iter(self._pending.items()))
+                delay = ready_at - monotonic()
+                if delay <= 0:
+                    delay = self._bucket.take()
+                    if delay <= 0:
+                        del self._pending[chat_id]
+                        self._sending = True
+                        return chat_id, texts
+                self._condition.wait(delay)
+
+    def _run(self):
+        while True:
+            chat_id, texts = self._next()
+            text, remaining = combine(texts)
+            try:
+                self._gate.wait()
+                self._send(chat_id, text)
+                MESSAGES.inc(result='sent')
+            except RetryAfter as e:
+                logging.warning(f'Telegram rate limit reached, pausing messages for {e.retry_after} seconds')
+                self._gate.block_for(e.retry_after)
+                MESSAGES.inc(result='rate_limited')
+                remaining = texts
+            except TelegramError as e:
+                # E.g. the bot was blocked or removed from the chat, there is nobody to tell about it
+                logging.warning(f'Unable to send message to chat {chat_id}: {e}')
+                MESSAGES.inc(result='failed')
+            except Exception:
+                logging.exception(f'Unable to send message to chat {chat_id}')
+                MESSAGES.inc(result='failed')
+            with self._condition:
+                if remaining:
+                    if chat_id in self._pending:
+                        remaining += self._pending.pop(chat_id)[1]
+                    self._pending[chat_id] = (monotonic() + CHAT_MESSAGE_INTERVAL, remaining)
+                self._sending = False
+                self._condition.notify_all()
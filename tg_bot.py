@@ -1,58 +1,79 @@
 #!/usr/bin/env python3
+from time import perf_counter
+
+# Taken before the other imports, so the startup report includes them
+STARTED_AT = perf_counter()
+
+import csv
+import io
+import json
 import os
-import sentry_sdk
+import secrets
 from datetime import datetime
-from typing import List
+from typing import List, Optional, Tuple
 
 import tweepy
 
 import logging
 
-from sentry_sdk.integrations.redis import RedisIntegration
-from sentry_sdk.integrations.tornado import TornadoIntegration
-from telegram import BotCommand, Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, ReplyKeyboardRemove
+from telegram import Bot, BotCommand, Document, Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, \
+    ReplyKeyboardRemove
 from telegram.ext import CommandHandler, CallbackContext, MessageHandler, Filters, CallbackQueryHandler
-import pytz
-from pytz import timezone
-
-from common import TWEET_CHARACTER_LIMIT, redis, get_twitter_auth, get_twitter_api, MAX_QUEUE_SIZE, \
-    get_telegram_updater, build_tweet_url, check_env_variables
 
-sentry_sdk.init(
-    os.environ.get('SENTRY_DSN'),
-    traces_sample_rate=1.0,
-    integrations=[RedisIntegration(), TornadoIntegration()],
-)
+from common import TWEET_CHARACTER_LIMIT, get_twitter_auth, get_twitter_api, MAX_QUEUE_SIZE, \
+    get_telegram_updater, build_tweet_url, check_env_variables, enqueue_many, pop_queue_tail, update_setting, \
+    authorize_chat, migrate_chat, post_status, get_chat_settings, buffer_media_group_part, take_media_group, \
+    Attachment, QueueFullError, init_sentry, report_startup, get_timezone
+from media import validate_attachment
+from metrics import Histogram, start_metrics_server
+from timezones import ALL_TIMEZONES, REGION_MARKUP, ZONE_MARKUPS, CHANGE_TIMEZONE_MARKUP, get_zone_markup
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.getLevelName(os.environ.get('LOG_LEVEL', 'INFO')))
 
-
-def get_timezone_region_markup(continents):
-    return InlineKeyboardMarkup(
-        [[InlineKeyboardButton(x, callback_data=':'.join(['timezone', x])) for x in continents[i:i + 3]]
-         for i in range(0, len(continents), 3)]
-    )
+# Number of threads of the dispatcher that run asynchronous handlers
+TELEGRAM_WORKERS = int(os.environ.get('TELEGRAM_WORKERS', 8))
+# Handlers that run on the dispatchers worker threads (or "all"). Defaults to the ones waiting for twitter.
+# Messages are handled synchronously by default, so they end up in the queue in the order they were sent
+TELEGRAM_RUN_ASYNC = set(os.environ.get('TELEGRAM_RUN_ASYNC', 'start,test_tweet,authorize').split(','))
+# If set, updates are received by a webhook instead of polling, e.g. https://example.com
+TELEGRAM_WEBHOOK_URL = os.environ.get('TELEGRAM_WEBHOOK_URL')
+TELEGRAM_WEBHOOK_LISTEN = os.environ.get('TELEGRAM_WEBHOOK_LISTEN', '0.0.0.0')
+TELEGRAM_WEBHOOK_PORT = int(os.environ.get('TELEGRAM_WEBHOOK_PORT', 8443))
+TELEGRAM_WEBHOOK_SECRET_PATH = os.environ.get('TELEGRAM_WEBHOOK_SECRET_PATH') or secrets.token_urlsafe(32)
+# Seconds to wait for the remaining parts of an album after its first part arrived
+MEDIA_GROUP_DELAY = 2
+# Documents of these types (or with these extensions) are imported as many tweets instead of being attached
+IMPORT_FORMATS = {
+    'text/plain': 'txt',
+    'text/csv': 'csv',
+    'text/comma-separated-values': 'csv',
+    'application/json': 'json',
+    '.txt': 'txt',
+    '.csv': 'csv',
+    '.json': 'json',
+}
+IMPORT_MAX_SIZE = 1024 * 1024
+
+HANDLER_DURATION = Histogram('telegram_handler_duration_seconds', 'Time needed to handle an update', ('handler',))
 
 
 def handle_timezone_command(update: Update, context: CallbackContext):
-    continents = sorted(set([x.partition('/')[0] for x in pytz.common_timezones]))
-    current_timezone = redis.get(f'chat:{update.message.chat_id}:settings:timezone')
-    reply = get_timezone_region_markup(continents)
+    _, current_timezone = get_chat_settings(update.message.chat_id)
     context.bot.send_message(chat_id=update.message.chat_id,
                              text=f'Your current timezone is set to "{current_timezone}". '
                                   'If you want to change it, choose your region',
-                             reply_markup=reply)
+                             reply_markup=REGION_MARKUP)
 
 
 def handle_clock_command(update: Update, context: CallbackContext):
     chat_id = update.message.chat_id
-    current_timezone = redis.get(f'chat:{chat_id}:settings:timezone')
+    _, current_timezone = get_chat_settings(chat_id)
     if not current_timezone:
         context.bot.send_message(chat_id=chat_id,
                                  text="Sorry to interrupt you, but you need to set a /timezone")
         return
-    tz = timezone(current_timezone)
+    tz = get_timezone(current_timezone)
     msg_sent_date = update.message.date.astimezone(tz)
     context.bot.send_message(chat_id=update.message.chat_id, text=f'I received your message at {msg_sent_date}')
 
@@ -61,25 +82,23 @@ def handle_start_command(update: Update, context: CallbackContext):
     auth = get_twitter_auth()
     auth_url = auth.get_authorization_url()
     chat_id = update.message.chat_id
-    context.bot.send_message(chat_id=chat_id,
-                             text='I will tweet a message or photo from you each day. '
-                                  'Everything you send me will be added to a queue and tweeted later. ',
-                             reply_markup=ReplyKeyboardRemove())
+    # One message instead of several, telegram limits the messages per chat
+    text = ('I will tweet a message or photo from you each day. '
+            'Everything you send me will be added to a queue and tweeted later.\n\n')
     if update.message.chat.type != update.message.chat.GROUP:
-        context.bot.send_message(chat_id=chat_id, text='You can also add me to groups!')
-    context.bot.send_message(chat_id=chat_id,
-                             text=f'Start by giving me access your twitter account: {auth_url}')
+        text += 'You can also add me to groups!\n\n'
+    text += f'Start by giving me access your twitter account: {auth_url}'
+    context.bot.send_message(chat_id=chat_id, text=text, reply_markup=ReplyKeyboardRemove())
 
 
 def handle_test_tweet_command(update: Update, context: CallbackContext):
     twitter = get_twitter_api(chat_id=update.message.chat_id)
     try:
-        status = twitter.update_status(
-            f'https://t.me/{context.bot.username} was successfully configured for this account!')
+        status = post_status(twitter,
+                             f'https://t.me/{context.bot.username} was successfully configured for this account!')
     except tweepy.error.TweepError as e:
-        context.bot.send_message(chat_id=update.message.chat_id, text=e.reason)
         context.bot.send_message(chat_id=update.message.chat_id,
-                                 text='Sorry, I was unable to tweet something. Try /start')
+                                 text=f'{e.reason}\n\nSorry, I was unable to tweet something. Try /start')
         return
     tweet_url = build_tweet_url(status)
     context.bot.send_message(chat_id=update.message.chat_id, text=f'Here is your tweet: {tweet_url}')
@@ -107,19 +126,11 @@ def handle_authorize_command(update: Update, context: CallbackContext):
         context.bot.send_message(chat_id=chat_id,
                                  text='I was unable to get an access token. Try again: /start')
         return
-    redis.set(f'chat:{chat_id}:oauth:access_token', access_token)
-    redis.set(f'chat:{chat_id}:oauth:access_token_secret', access_token_secret)
-    if not redis.get(f'chat:{chat_id}:settings:timezone'):
-        redis.set(f'chat:{chat_id}:settings:timezone', 'UTC')
-    tz = redis.get(f'chat:{chat_id}:settings:timezone')
-    if not redis.get(f'chat:{chat_id}:settings:tweet_time'):
-        redis.set(f'chat:{chat_id}:settings:tweet_time', '12:00')
-    tweet_time = redis.get(f'chat:{chat_id}:settings:tweet_time')
+    tweet_time, tz = authorize_chat(chat_id, access_token, access_token_secret)
     context.bot.send_message(chat_id=chat_id,
                              text="You're all set! If you want to, you can test if "
-                                  "everything works by posting a tweet: /test_tweet")
-    context.bot.send_message(chat_id=chat_id,
-                             text=f'I will tweet at {tweet_time} ({tz}). You can change that: /tweet_time, /timezone')
+                                  "everything works by posting a tweet: /test_tweet\n\n"
+                                  f'I will tweet at {tweet_time} ({tz}). You can change that: /tweet_time, /timezone')
 
 
 def find_largest_photo(photos):
@@ -135,30 +146,135 @@ def find_largest_photo(photos):
 
 def handle_messages(update: Update, context: CallbackContext):
     chat_id = update.message.chat_id
-    if not redis.get(f'chat:{chat_id}:oauth:access_token'):
-        context.bot.send_message(chat_id=chat_id, text='You need to set me up first. Click on /start')
-        return
     text = update.message.text or update.message.caption or ''
-    if len(text) > TWEET_CHARACTER_LIMIT:
-        context.bot.send_message(chat_id=chat_id,
-                                 text=f'Sorry, your text exceeds the limit of {TWEET_CHARACTER_LIMIT} characters.')
-    queue_size = redis.get(f'chat:{chat_id}:queue_size')
-    if queue_size is None:
-        queue_size = 0
-    queue_size = int(queue_size)
-    if queue_size >= MAX_QUEUE_SIZE:
-        context.bot.send_message(chat_id=chat_id, text='You have exceeded the maximum queue size.')
-    redis.set(f'chat:{chat_id}:queue:{queue_size}:text', text)
-    if update.message.document:
-        redis.set(f'chat:{chat_id}:queue:{queue_size}:tg_attachment_id', update.message.document.file_id)
+    document = update.message.document
+    if document and get_import_format(document):
+        handle_import(update, context, document)
+        return
+    attachment = None
+    if document:
+        attachment = document
+    elif update.message.video:
+        attachment = update.message.video
     elif update.message.photo:
-        redis.set(f'chat:{chat_id}:queue:{queue_size}:tg_attachment_id',
-                  find_largest_photo(update.message.photo).file_id)
-    queue_size += 1
-    redis.set(f'chat:{chat_id}:queue_size', queue_size)
-    tweet_time = redis.get(f'chat:{chat_id}:settings:tweet_time')
-    context.bot.send_message(chat_id=chat_id,
-                             text=f'Ok, I will tweet that at {tweet_time}! You now have {queue_size} tweet(s) in your queue.')
+        attachment = find_largest_photo(update.message.photo)
+    if attachment is not None:
+        # Photos do not have a mime type, telegram always sends them as JPEG
+        attachment = (attachment.file_id, getattr(attachment, 'mime_type', 'image/jpeg'), attachment.file_size)
+    media_group_id = update.message.media_group_id
+    if media_group_id:
+        # The parts of an album arrive as separate messages, they are added once all of them arrived
+        if buffer_media_group_part(media_group_id, update.message.message_id, text, attachment):
+            context.job_queue.run_once(flush_media_group, MEDIA_GROUP_DELAY, context=(chat_id, media_group_id))
+        return
+    enqueue_items(context.bot, chat_id, [(text, attachment)])
+
+
+def flush_media_group(context: CallbackContext):
+    chat_id, media_group_id = context.job.context
+    with HANDLER_DURATION.time(handler='media_group'):
+        items = take_media_group(media_group_id)
+        if items:
+            enqueue_items(context.bot, chat_id, items)
+
+
+def get_import_format(document: Document) -> Optional[str]:
+    """Returns the format of a document that contains tweets to import, or None if it is an attachment"""
+    extension = os.path.splitext(document.file_name or '')[1].lower()
+    return IMPORT_FORMATS.get(document.mime_type) or IMPORT_FORMATS.get(extension)
+
+
+def parse_import(content: str, import_format: str) -> List[str]:
+    """
+    Returns the tweets of an imported file. Text files contain one tweet per line, CSV files one per row
+    (the first column, an optional header "text" is skipped) and JSON files a list of texts or of objects with a text
+    """
+    if import_format == 'json':
+        items = json.loads(content)
+        if not isinstance(items, list):
+            raise ValueError('Expected a list of tweets')
+        texts = [item.get('text') if isinstance(item, dict) else item for item in items]
+        for number, text in enumerate(texts, 1):
+            if not isinstance(text, str):
+                raise ValueError(f'Tweet #{number} is not a text')
+    elif import_format == 'csv':
+        rows = [row for row in csv.reader(io.StringIO(content)) if row]
+        if rows and rows[0][0].strip().lower() == 'text':
+            rows = rows[1:]
+        texts = [row[0] for row in rows]
+    else:
+        texts = content.splitlines()
+    return [text.strip() for text in texts if text.strip()]
+
+
+def handle_import(update: Update, context: CallbackContext, document: Document):
+    chat_id = update.message.chat_id
+    if document.file_size and document.file_size > IMPORT_MAX_SIZE:
+        context.bot.send_message(chat_id=chat_id, text=f'Sorry, this file is too large. '
+                                                       f'It may not exceed {IMPORT_MAX_SIZE // 1024} KB.')
+        return
+    content = context.bot.get_file(document.file_id).download_as_bytearray()
+    try:
+        texts = parse_import(bytes(content).decode('utf-8-sig'), get_import_format(document))
+    except (ValueError, csv.Error) as e:
+        context.bot.send_message(chat_id=chat_id, text=f'Sorry, I could not read this file: {e}')
+        return
+    if not texts:
+        context.bot.send_message(chat_id=chat_id, text='Sorry, I did not find any tweets in this file.')
+        return
+    if len(texts) > MAX_QUEUE_SIZE:
+        context.bot.send_message(chat_id=chat_id, text=f'Sorry, you can import at most {MAX_QUEUE_SIZE} tweets '
+                                                       f'at once. This file contains {len(texts)}.')
+        return
+    enqueue_items(context.bot, chat_id, [(text, None) for text in texts])
+
+
+def check_item(text: str, attachment: Optional[Attachment]) -> Optional[str]:
+    """Returns the reason why the text and attachment can not be tweeted, or None if they are fine"""
+    if len(text) > TWEET_CHARACTER_LIMIT:
+        return f'Sorry, your text exceeds the limit of {TWEET_CHARACTER_LIMIT} characters.'
+    if attachment is not None:
+        _, mime_type, file_size = attachment
+        return validate_attachment(mime_type, file_size)
+    return None
+
+
+def enqueue_items(bot: Bot, chat_id, items: List[Tuple[str, Optional[Attachment]]]):
+    """
+    Validates all items before adding the valid ones to the queue in a single operation,
+    and sends a single reply with the result
+    """
+    entries = []
+    errors = []
+    for number, (text, attachment) in enumerate(items, 1):
+        error = check_item(text, attachment)
+        if error:
+            errors.append(error if len(items) == 1 else f'#{number}: {error}')
+        else:
+            entries.append((text, attachment[0] if attachment else None))
+    if not entries:
+        bot.send_message(chat_id=chat_id, text='\n'.join(errors))
+        return
+    try:
+        result = enqueue_many(chat_id, entries)
+    except QueueFullError as e:
+        bot.send_message(chat_id=chat_id, text=f'Sorry, your queue is full. It may contain at most {MAX_QUEUE_SIZE} '
+                                               f'tweets, there are {e.queue_size} tweet(s) in it already. '
+                                               f'I did not add {"this" if len(entries) == 1 else "any of these"}.')
+        return
+    if result is None:
+        bot.send_message(chat_id=chat_id, text='You need to set me up first. Click on /start')
+        return
+    queue_size, tweet_time = result
+    paragraphs = []
+    if errors:
+        paragraphs.append('\n'.join([f'I skipped {len(errors)} of {len(items)} items:'] + errors))
+    if len(items) == 1:
+        paragraphs.append(f'Ok, I will tweet that at {tweet_time}! You now have {queue_size} tweet(s) in your queue.')
+    else:
+        paragraphs.append(f'Ok, I added {len(entries)} tweets to your queue and will tweet one of them every day '
+                          f'at {tweet_time}! You now have {queue_size} tweet(s) in your queue.')
+    bot.send_message(chat_id=chat_id, text='\n\n'.join(paragraphs))
 
 
 def handle_migrate_chat(update: Update, context: CallbackContext):
@@ -166,10 +282,8 @@ def handle_migrate_chat(update: Update, context: CallbackContext):
     new_chat_id = update.message.chat_id
     if old_chat_id is None or new_chat_id is None:
         return
-    logging.info(f'Supergroup migration. Renaming redis keys chat:{old_chat_id}:* to chat:{new_chat_id}:*')
-    for key in redis.keys(f'chat:{old_chat_id}:*'):
-        new_key = key.replace(f'chat:{old_chat_id}:', f'chat:{new_chat_id}:')
-        redis.rename(key, new_key)
+    logging.info(f'Supergroup migration. Moving chat {old_chat_id} to {new_chat_id}')
+    migrate_chat(old_chat_id, new_chat_id)
 
 
 def handle_tweet_time_command(update: Update, context: CallbackContext):
@@ -182,7 +296,7 @@ def handle_tweet_time_command(update: Update, context: CallbackContext):
         ) for minute in range(0, 60, 15)])
     buttons.append([InlineKeyboardButton('Cancel', callback_data=f'cancel')])
     reply = InlineKeyboardMarkup(buttons, one_time_keyboard=True)
-    tweet_time = redis.get(f'chat:{chat_id}:settings:tweet_time')
+    tweet_time, _ = get_chat_settings(chat_id)
     context.bot.send_message(chat_id=update.message.chat_id,
                              text=f'Your current tweet time is {tweet_time}. Do you want to change it?',
                              reply_markup=reply)
@@ -190,22 +304,11 @@ def handle_tweet_time_command(update: Update, context: CallbackContext):
 
 def handle_delete_last_command(update: Update, context: CallbackContext):
     chat_id = update.message.chat_id
-    queue_size = redis.get(f'chat:{chat_id}:queue_size')
-    if queue_size is None:
-        queue_size = 0
-    queue_size = int(queue_size)
-    if queue_size <= 0:
+    entry = pop_queue_tail(chat_id)
+    if entry is None:
         context.bot.send_message(chat_id=chat_id, text='Queue is empty')
         return
-    queue_size -= 1
-
-    tweet_text = redis.get(f'chat:{chat_id}:queue:{queue_size}:text') or ''
-    tg_attachment_id = redis.get(f'chat:{chat_id}:queue:{queue_size}:tg_attachment_id')
-
-    redis.delete(f'chat:{chat_id}:queue:{queue_size}:text')
-    redis.delete(f'chat:{chat_id}:queue:{queue_size}:tg_attachment_id')
-
-    redis.set(f'chat:{chat_id}:queue_size', queue_size)
+    tweet_text, tg_attachment_id = entry
 
     context.bot.send_message(chat_id=chat_id, text="I've deleted your latest tweet. This was the text: " + tweet_text)
     if tg_attachment_id:
@@ -217,6 +320,10 @@ def handle_help_command(update: Update, context: CallbackContext):
                              text='Send me messages and photos - I will put each message in a queue. '
                                   'Every day, I post the first item of the queue on twitter.\n'
                                   '\n'
+                                  'To add many tweets at once, send me a .txt file with one tweet per line, '
+                                  'a .csv file with one tweet per row or a .json file with a list of tweets. '
+                                  'Each photo of an album becomes a tweet of its own.\n'
+                                  '\n'
                                   '/start - connect me to twitter\n'
                                   '/tweet_time - when do you want me to tweet?\n'
                                   '/timezone - configure your timezone\n'
@@ -240,32 +347,30 @@ def handle_inlinebutton_click(update: Update, context: CallbackContext):
 
 
 def inlinebutton_timezone(update: Update, context: CallbackContext, query: CallbackQuery, args: List[str]):
-    continents = sorted(set([x.partition('/')[0] for x in pytz.common_timezones]))
     location = args[0]
     if location == 'region_selection':
-        reply = get_timezone_region_markup(continents)
         query.edit_message_text('Choose your region')
-        query.edit_message_reply_markup(reply)
-    elif location in pytz.all_timezones:
-        redis.set(f'chat:{query.message.chat_id}:settings:timezone', location)
-        tz = timezone(location)
+        query.edit_message_reply_markup(REGION_MARKUP)
+    elif location in ALL_TIMEZONES:
+        update_setting(query.message.chat_id, 'timezone', location)
+        tz = get_timezone(location)
         local_time = query.message.date.astimezone(tz).strftime('%X')
-        reply = InlineKeyboardMarkup(
-            [[(InlineKeyboardButton('Change timezone', callback_data='timezone:region_selection'))]]
-        )
         query.edit_message_text(
             f'Timezone of this chat was set to {location}. '
             f'Looks like it was {local_time} when you sent the last /timezone command. '
             'If this is incorrect, please execute /timezone again or click the button below.'
         )
-        query.edit_message_reply_markup(reply)
-    elif location in continents:
-        zones = [x for x in pytz.all_timezones if x.startswith(location)]
-        reply = InlineKeyboardMarkup(
-            [[InlineKeyboardButton(x.partition('/')[2], callback_data=':'.join(['timezone', x]))] for x in zones]
-            + [[(InlineKeyboardButton('« Back', callback_data='timezone:region_selection'))]],
-        )
-        query.edit_message_text('Choose your timezone')
+        query.edit_message_reply_markup(CHANGE_TIMEZONE_MARKUP)
+    elif location in ZONE_MARKUPS:
+        try:
+            page = int(args[1]) if len(args) > 1 else 0
+        except ValueError:
+            page = 0
+        reply, page, pages = get_zone_markup(location, page)
+        if pages > 1:
+            query.edit_message_text(f'Choose your timezone (page {page + 1} of {pages})')
+        else:
+            query.edit_message_text('Choose your timezone')
         query.edit_message_reply_markup(reply)
 
 
@@ -275,14 +380,29 @@ def inlinebutton_tweet_time(update: Update, context: CallbackContext, query: Cal
     except ValueError:
         query.edit_message_text("Sorry, I didn't understand that time. Time must be in format %H:%M")
         return
-    redis.set(f'chat:{query.message.chat_id}:settings:tweet_time', tweet_time)
+    update_setting(query.message.chat_id, 'tweet_time', tweet_time)
     query.edit_message_text(f'I will tweet at {tweet_time}')
 
 
+def run_async(handler: str) -> bool:
+    return handler in TELEGRAM_RUN_ASYNC or 'all' in TELEGRAM_RUN_ASYNC
+
+
+def timed(handler: str, callback):
+    """Records the duration of every call of `callback`"""
+    def wrapper(update: Update, context: CallbackContext):
+        with HANDLER_DURATION.time(handler=handler):
+            return callback(update, context)
+    return wrapper
+
+
 def main():
+    init_sentry()
     check_env_variables()
+    report_startup('imports', STARTED_AT)
 
-    telegram_updater = get_telegram_updater()
+    telegram_updater = get_telegram_updater(workers=TELEGRAM_WORKERS)
+    start_metrics_server()
 
     telegram_updater.bot.set_my_commands([
         BotCommand('start', 'Starts the authorization process'),
@@ -293,22 +413,39 @@ def main():
         BotCommand('test_tweet', 'Instantly sends a tweet to test authorization'),
         # BotCommand('clock', 'Outputs the date of the received message'),
     ])
-    telegram_updater.dispatcher.add_handler(CommandHandler('start', handle_start_command))
-    telegram_updater.dispatcher.add_handler(CommandHandler('delete_last', handle_delete_last_command))
-    telegram_updater.dispatcher.add_handler(CommandHandler('help', handle_help_command))
-    telegram_updater.dispatcher.add_handler(CommandHandler('timezone', handle_timezone_command))
-    telegram_updater.dispatcher.add_handler(CommandHandler('clock', handle_clock_command))
-    telegram_updater.dispatcher.add_handler(CommandHandler('tweet_time', handle_tweet_time_command))
-    telegram_updater.dispatcher.add_handler(CommandHandler('test_tweet', handle_test_tweet_command))
-    telegram_updater.dispatcher.add_handler(CommandHandler('authorize', handle_authorize_command))
-    telegram_updater.dispatcher.add_handler(CallbackQueryHandler(handle_inlinebutton_click))
+    for command, callback in [
+        ('start', handle_start_command),
+        ('delete_last', handle_delete_last_command),
+        ('help', handle_help_command),
+        ('timezone', handle_timezone_command),
+        ('clock', handle_clock_command),
+        ('tweet_time', handle_tweet_time_command),
+        ('test_tweet', handle_test_tweet_command),
+        ('authorize', handle_authorize_command),
+    ]:
+        telegram_updater.dispatcher.add_handler(
+            CommandHandler(command, timed(command, callback), run_async=run_async(command)))
     telegram_updater.dispatcher.add_handler(
-        MessageHandler((Filters.private | Filters.group) & (Filters.text | Filters.photo | Filters.document),
-                       handle_messages))
-    telegram_updater.dispatcher.add_handler(MessageHandler(Filters.status_update.migrate, handle_migrate_chat))
-
-    logging.info('Ready, now polling telegram')
-    telegram_updater.start_polling()
+        CallbackQueryHandler(timed('inlinebutton', handle_inlinebutton_click), run_async=run_async('inlinebutton')))
+    telegram_updater.dispatcher.add_handler(
+        MessageHandler((Filters.private | Filters.group)
+                       & (Filters.text | Filters.photo | Filters.document | Filters.video),
+                       timed('messages', handle_messages), run_async=run_async('messages')))
+    telegram_updater.dispatcher.add_handler(
+        MessageHandler(Filters.status_update.migrate, timed('migrate', handle_migrate_chat),
+                       run_async=run_async('migrate')))
+
+    if TELEGRAM_WEBHOOK_URL:
+        logging.info(f'Ready, now listening for telegram updates on {TELEGRAM_WEBHOOK_LISTEN}:{TELEGRAM_WEBHOOK_PORT}')
+        telegram_updater.start_webhook(listen=TELEGRAM_WEBHOOK_LISTEN,
+                                       port=TELEGRAM_WEBHOOK_PORT,
+                                       url_path=TELEGRAM_WEBHOOK_SECRET_PATH,
+                                       webhook_url=f'{TELEGRAM_WEBHOOK_URL.rstrip("/")}/{TELEGRAM_WEBHOOK_SECRET_PATH}')
+    else:
+        logging.info('Ready, now polling telegram')
+        telegram_updater.start_polling()
+    report_startup('listening', STARTED_AT)
+    telegram_updater.idle()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,56 @@
+"""
+Timezone index, built once on import: the regions offered to users, the zones of each region
+and their (paginated) inline keyboards. Only needed by the bot; tz objects are provided by common.get_timezone.
+"""
+from typing import Dict, List, Tuple
+
+import pytz
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+TIMEZONES_PER_PAGE = 20
+
+ALL_TIMEZONES = frozenset(pytz.all_timezones)
+REGIONS = sorted(set(x.partition('/')[0] for x in pytz.common_timezones))
+ZONES_BY_REGION: Dict[str, List[str]] = {
+    region: [x for x in pytz.all_timezones if x.startswith(region)] for region in REGIONS
+}
+
+
+def _build_region_markup() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton(x, callback_data=':'.join(['timezone', x])) for x in REGIONS[i:i + 3]]
+         for i in range(0, len(REGIONS), 3)]
+    )
+
+
+def _build_zone_markups(region: str) -> List[InlineKeyboardMarkup]:
+    zones = ZONES_BY_REGION[region]
+    pages = [zones[i:i + TIMEZONES_PER_PAGE] for i in range(0, len(zones), TIMEZONES_PER_PAGE)] or [[]]
+    markups = []
+    for page, page_zones in enumerate(pages):
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton('‹ Previous', callback_data=f'timezone:{region}:{page - 1}'))
+        if page < len(pages) - 1:
+            navigation.append(InlineKeyboardButton('Next ›', callback_data=f'timezone:{region}:{page + 1}'))
+        markups.append(InlineKeyboardMarkup(
+            [[InlineKeyboardButton(x.partition('/')[2], callback_data=':'.join(['timezone', x]))] for x in page_zones]
+            + ([navigation] if navigation else [])
+            + [[InlineKeyboardButton('« Back', callback_data='timezone:region_selection')]]
+        ))
+    return markups
+
+
+REGION_MARKUP = _build_region_markup()
+# region -> one keyboard per page
+ZONE_MARKUPS: Dict[str, List[InlineKeyboardMarkup]] = {region: _build_zone_markups(region) for region in REGIONS}
+CHANGE_TIMEZONE_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton('Change timezone', callback_data='timezone:region_selection')]]
+)
+
+
+def get_zone_markup(region: str, page: int) -> Tuple[InlineKeyboardMarkup, int, int]:
+    """Returns the keyboard of the page, the page (clamped to the existing pages) and the number of pages"""
+    markups = ZONE_MARKUPS[region]
+    page = max(0, min(page, len(markups) - 1))
+    return markups[page], page, len(markups)
@@ -1,126 +1,396 @@
 #!/usr/bin/env python3
+from time import perf_counter
+
+# Taken before the other imports, so the startup report includes them
+STARTED_AT = perf_counter()
+
+import hashlib
 import logging
 import os
+import random
+import signal
+import socket
 import sys
 import threading
-from time import sleep
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import sleep, time
+from datetime import datetime, timedelta
+from typing import List, Optional
 
-import sentry_sdk
+import requests
 import tweepy
-from pytz import timezone
-from sentry_sdk.integrations.redis import RedisIntegration
-from sentry_sdk.integrations.tornado import TornadoIntegration
+from pytz import utc
+from telegram.error import TelegramError
 
-from common import redis, get_twitter_api, get_telegram_updater, FILE_STORAGE_PATH, build_tweet_url, check_env_variables
-
-sentry_sdk.init(
-    os.environ.get('SENTRY_DSN'),
-    traces_sample_rate=1.0,
-    integrations=[RedisIntegration(), TornadoIntegration()],
-)
+from common import get_redis, get_twitter_api, get_telegram_bot, FILE_STORAGE_PATH, build_tweet_url, \
+    check_env_variables, get_due_chats, backfill_schedule, SCHEDULE_KEY, claim_due_chat, dequeue_after_post, \
+    RateLimitGate, get_queue_heads, post_status, schedule_chat, redis_operation, count_failed_attempt, \
+    reset_failed_attempts, unschedule_chat, init_sentry, report_startup, deserialize_queue_entry, migrate_legacy_queues
+from media import MediaCache, MediaProcessingTimeoutError, MediaRejectedError, download_file, upload_media, \
+    forget_upload
+from metrics import Counter, Gauge, Histogram, start_metrics_server
+from notifications import Notifier
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.getLevelName(os.environ.get('LOG_LEVEL', 'INFO')))
 
+# Start of the last minute (UNIX timestamp) for which all due chats were processed
+LAST_PROCESSED_MINUTE_KEY = 'tweet:last_processed_minute'
+# Sorted set of running scheduler instances, scored by the UNIX timestamp of their last heartbeat
+INSTANCES_KEY = 'tweet:instances'
+INSTANCE_ID = os.environ.get('TWEET_INSTANCE_ID') or f'{socket.gethostname()}:{os.getpid()}'
+HEARTBEAT_INTERVAL = 10
+# Instances without a heartbeat for that long are considered dead, their chats are taken over by the others
+INSTANCE_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+# Number of chats that are posted concurrently
+TWEET_WORKERS = int(os.environ.get('TWEET_WORKERS', 16))
+# Used if twitter does not tell us when its rate limit resets
+DEFAULT_RATE_LIMIT_DELAY = 60
+# Failed tweets are retried with exponential backoff, starting with that many seconds...
+RETRY_BASE_DELAY = 60
+# ...until they failed that many times in a row. Then, the chat is notified and they are retried the next day
+MAX_POST_ATTEMPTS = 5
+
+# Twitter API error codes, see https://developer.twitter.com/en/support/twitter-api/error-troubleshooting
+# Rate limit exceeded, over capacity, internal error, over daily status update limit
+TRANSIENT_ERROR_CODES = {88, 130, 131, 185}
+DUPLICATE_STATUS_ERROR_CODE = 187
+# Could not authenticate, account suspended, invalid or expired token, account locked
+UNAUTHORIZED_ERROR_CODES = {32, 64, 89, 326}
+
+# Attachments of chats that are due within that many seconds are downloaded in advance
+MEDIA_PREFETCH_AHEAD = int(os.environ.get('MEDIA_PREFETCH_AHEAD', 15 * 60))
+MEDIA_PREFETCH_WORKERS = 4
+
+LOOP_DURATION = Histogram('tweet_loop_duration_seconds', 'Time needed to post the tweets of all due chats')
+CHATS_DUE = Gauge('tweet_chats_due', 'Number of chats of this instance that were due in the last run')
+INSTANCES = Gauge('tweet_instances', 'Number of live scheduler instances')
+POSTS = Counter('tweet_posts_total', 'Processed tweets, by result and reason of failure', ('result', 'reason'))
+POSTING_LAG = Histogram('tweet_posting_lag_seconds', 'Delay between the scheduled time and posting a tweet')
+
+telegram_rate_limit = RateLimitGate()
+prefetch_executor = ThreadPoolExecutor(max_workers=MEDIA_PREFETCH_WORKERS, thread_name_prefix='prefetch')
+
 
-def run_threaded(job_func):
-    job_thread = threading.Thread(target=job_func)
-    job_thread.start()
+def seconds_until_next_minute() -> float:
+    return 60 - time() % 60
+
+
+def run_scheduler(started_at: Optional[float] = None):
+    """
+    Runs `tick` at the start of every wall-clock minute, starting with an immediate run to catch up.
+    The time until that first run completed is reported as part of the startup, if `started_at` is given
+    """
+    while True:
+        try:
+            tick()
+        except Exception:
+            logging.exception('Scheduled run failed')
+        if started_at is not None:
+            report_startup('first tick', started_at)
+            started_at = None
+        sleep(seconds_until_next_minute())
+
+
+def heartbeat():
+    """Keeps this instance registered while the process is alive, even if a run takes longer than a minute"""
+    while True:
+        try:
+            get_redis().zadd(INSTANCES_KEY, {INSTANCE_ID: time()})
+        except Exception:
+            logging.exception('Unable to send heartbeat')
+        sleep(HEARTBEAT_INTERVAL)
 
 
-def loop():
-    now = datetime.now()
+@redis_operation('get_instances')
+def get_live_instances() -> List[str]:
+    """Returns the ids of all running instances (including this one) and forgets about dead ones"""
+    pipeline = get_redis().pipeline(transaction=False)
+    pipeline.zremrangebyscore(INSTANCES_KEY, '-inf', time() - INSTANCE_TIMEOUT)
+    pipeline.zrange(INSTANCES_KEY, 0, -1)
+    instances = set(pipeline.execute()[1])
+    instances.add(INSTANCE_ID)
+    return sorted(instances)
+
+
+def is_responsible(chat_id, instances: List[str]) -> bool:
+    """
+    Rendezvous hashing: each chat belongs to the instance with the highest hash of instance and chat id.
+    When an instance joins or leaves, only the chats it owns (or gets) move
+    """
+    return max(instances, key=lambda instance: hashlib.sha1(f'{instance}:{chat_id}'.encode()).digest()) == INSTANCE_ID
+
+
+def tick():
+    """
+    Processes the due chats this instance is responsible for. Chats that became due while no run was possible
+    (because the previous run took too long, or the process was down) are still due and are processed in the
+    next run - by whichever instance is responsible for them by then.
+
+    Every instance only sees its share of the chats, but the live instances might briefly disagree about their
+    shares when one joins or leaves. Each chat is therefore claimed atomically before it is posted, so it is posted
+    once no matter how many instances try.
+    """
+    now = datetime.now(utc)
+    minute = int(now.timestamp()) // 60 * 60
+    last_processed_minute = get_redis().get(LAST_PROCESSED_MINUTE_KEY)
+    if last_processed_minute is not None and minute - int(last_processed_minute) > 60:
+        logging.warning(f'Catching up {(minute - int(last_processed_minute)) // 60 - 1} missed minute(s)')
+    instances = get_live_instances()
+    INSTANCES.set(len(instances))
+    loop(now, instances)
+    get_redis().set(LAST_PROCESSED_MINUTE_KEY, minute)
+    prefetch_media(now, instances)
+
+
+def loop(now: Optional[datetime] = None, instances: Optional[List[str]] = None):
+    now = now or datetime.now(utc)
     logging.debug(f'Running with timestamp {now}')
-    for key in redis.keys('*:settings:tweet_time'):
-        chat_id = key.split(':')[1]
-        desired_time = redis.get(key).split(':')
-        desired_hour = int(desired_time[0])
-        desired_minute = int(desired_time[1])
-        local_now = now.astimezone(timezone(redis.get(f'chat:{chat_id}:settings:timezone') or 'UTC'))
-        if desired_hour != local_now.hour or desired_minute != local_now.minute:
-            continue
-        queue_size = redis.get(f'chat:{chat_id}:queue_size') or 0
-        queue_size = int(queue_size)
-        if queue_size <= 0:
-            continue
-        queue_size -= 1
-        tweet_text = redis.get(f'chat:{chat_id}:queue:0:text')
-        tg_attachment_id = redis.get(f'chat:{chat_id}:queue:0:tg_attachment_id')
-
-        twitter = get_twitter_api(chat_id)
-
-        if not tg_attachment_id:
+    due_chats = get_due_chats(now, with_scores=True)
+    if instances is not None:
+        due_chats = [(chat_id, due_at) for chat_id, due_at in due_chats if is_responsible(chat_id, instances)]
+    CHATS_DUE.set(len(due_chats))
+    if not due_chats:
+        return
+    with LOOP_DURATION.time(), ThreadPoolExecutor(max_workers=TWEET_WORKERS, thread_name_prefix='tweet') as executor:
+        futures = {executor.submit(tweet_next_in_queue, chat_id, now, due_at): chat_id for chat_id, due_at in due_chats}
+        for future in as_completed(futures):
             try:
-                status = twitter.update_status(tweet_text)
-            except tweepy.error.TweepError as e:
-                logging.warning(f'Unable to tweet for chat:{chat_id}:queue:{queue_size} (without attachment) '
-                                f'Reason: {e.reason}')
-                telegram_updater.bot.send_message(chat_id=chat_id, text=e.reason)
-                telegram_updater.bot.send_message(chat_id=chat_id, text='Sorry, I was unable to post your daily tweet. '
-                                                                        'This is your tweet:')
-                telegram_updater.bot.send_message(chat_id=chat_id, text=tweet_text)
-                telegram_updater.bot.send_message(chat_id=chat_id,
-                                                  text='You may delete it from the queue: /delete_last')
-                return
-        else:
-            # download telegram photo
-            logging.debug('Downloading telegram attachment')
-            file = telegram_updater.bot.getFile(tg_attachment_id)
-            filename = FILE_STORAGE_PATH / tg_attachment_id
-            file.download(filename)
+                future.result()
+            except Exception:
+                # A failing chat must not affect the others
+                logging.exception(f'Unable to process chat {futures[future]}')
 
-            try:
-                status = twitter.update_with_media(filename, tweet_text)
-            except tweepy.error.TweepError as e:
-                logging.warning(f'Unable to tweet for chat:{chat_id}:queue:{queue_size} (with attachment). '
-                                f'Reason: {e.reason}')
-                telegram_updater.bot.send_message(chat_id=chat_id, text=e.reason)
-                telegram_updater.bot.send_message(chat_id=chat_id,
-                                                  text='Sorry, I was unable to post your daily tweet. '
-                                                       'This is your tweet, and it contained one attachment:')
-                telegram_updater.bot.send_message(chat_id=chat_id, text=tweet_text)
-                telegram_updater.bot.send_message(chat_id=chat_id,
-                                                  text='You may delete it from the queue: /delete_last')
-                return
-            finally:
-                filename.unlink(missing_ok=True)
+
+def download_attachment(file_id: str, filename):
+    telegram_rate_limit.wait()
+    download_file(telegram_bot.getFile(file_id).file_path, filename)
+
+
+media_cache = MediaCache(FILE_STORAGE_PATH, download_attachment)
+
+
+def prefetch_media(now: datetime, instances: Optional[List[str]] = None):
+    """Downloads the attachments of chats that are due soon in the background"""
+    chat_ids = get_due_chats(now + timedelta(seconds=MEDIA_PREFETCH_AHEAD), since=now)
+    if instances is not None:
+        chat_ids = [chat_id for chat_id in chat_ids if is_responsible(chat_id, instances)]
+    for head in get_queue_heads(chat_ids):
+        if head is not None and head[1] and head[1] not in media_cache:
+            prefetch_executor.submit(prefetch_attachment, head[1])
+
+
+def prefetch_attachment(file_id: str):
+    try:
+        media_cache.fetch(file_id)
+    except Exception:
+        logging.exception(f'Unable to prefetch attachment {file_id}')
+
+
+def send_telegram_message(chat_id, text: str):
+    telegram_bot.send_message(chat_id=chat_id, text=text)
+
+
+# Messages are sent in the background, so posting never waits for telegram
+notifier = Notifier(send_telegram_message, telegram_rate_limit)
+
+
+class AttachmentDownloadError(tweepy.TweepError):
+    """The attachment of a tweet could not be downloaded from telegram"""
+
+
+def failure_reason(e: tweepy.error.TweepError) -> str:
+    if isinstance(e, AttachmentDownloadError):
+        return 'download'
+    if isinstance(e, MediaRejectedError):
+        return 'media'
+    if isinstance(e, MediaProcessingTimeoutError):
+        return 'media_timeout'
+    if e.api_code is not None:
+        return str(e.api_code)
+    if e.response is not None:
+        return f'http_{e.response.status_code}'
+    return 'connection'
+
+
+def classify_failure(e: tweepy.error.TweepError) -> str:
+    """Returns 'transient', 'duplicate', 'unauthorized' or 'rejected' (for any other permanent failure)"""
+    status_code = getattr(e.response, 'status_code', None)
+    if isinstance(e, MediaRejectedError):
+        return 'rejected'
+    if e.api_code == DUPLICATE_STATUS_ERROR_CODE:
+        return 'duplicate'
+    if e.api_code in UNAUTHORIZED_ERROR_CODES or status_code == 401:
+        return 'unauthorized'
+    # Without a response, the request (or the download of the attachment) failed or timed out
+    if e.api_code in TRANSIENT_ERROR_CODES or status_code is None or status_code == 429 or status_code >= 500:
+        return 'transient'
+    return 'rejected'
+
+
+def retry_delay(attempt: int) -> float:
+    """Exponential backoff with jitter: between half and all of RETRY_BASE_DELAY * 2^(attempt - 1) seconds"""
+    delay = RETRY_BASE_DELAY * 2 ** (attempt - 1)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def rate_limit_delay(chat_id, e: tweepy.error.TweepError) -> float:
+    """
+    Returns the seconds until the rate limit that caused `e` is reset, or 0 if it was not caused by one.
+    Every request uses the token of the chat, so the limit only applies to that chat's account
+    """
+    if not isinstance(e, tweepy.error.RateLimitError) and getattr(e.response, 'status_code', None) != 429:
+        return 0
+    delay = DEFAULT_RATE_LIMIT_DELAY
+    reset = e.response.headers.get('x-rate-limit-reset') if e.response is not None else None
+    if reset is not None:
+        delay = max(int(reset) - time(), 0)
+    logging.warning(f'Twitter rate limit of chat {chat_id} reached, it is reset in {delay:.0f} seconds')
+    return delay
+
+
+def tweet_next_in_queue(chat_id, now: datetime, due_at: Optional[float] = None):
+    claim = claim_due_chat(chat_id, now)
+    if claim is None:
+        logging.debug(f'Chat {chat_id} was claimed by another run')
+        return
+    raw_head, settings = claim
+    failure = retry_at = None
+    try:
+        if raw_head is None:
+            return
+        try:
+            head = deserialize_queue_entry(raw_head)
+        except (ValueError, KeyError, TypeError):
+            # It would fail again on every attempt
+            logging.error(f'Dropping unreadable queue entry of chat {chat_id}: {raw_head!r}')
+            POSTS.inc(result='failure', reason='unreadable')
+            dequeue_after_post(chat_id)
+            notifier.send(chat_id, 'Sorry, I was unable to read the next tweet in your queue, so I removed it.')
+            return
+        try:
+            status = post_tweet(chat_id, *head)
+        except tweepy.error.TweepError as e:
+            failure = classify_failure(e)
+            retry_at = handle_failure(chat_id, head, failure, e)
+            return
+        POSTS.inc(result='success', reason='')
+        if due_at is not None:
+            POSTING_LAG.observe(time() - due_at)
         logging.debug('Deleting stored tweet and attachment id')
-        # Move all elements in the queue one
-        for i in range(queue_size):
-            k0 = f'chat:{chat_id}:queue:{i}:text'
-            k1 = f'chat:{chat_id}:queue:{i+1}:text'
-            l0 = f'chat:{chat_id}:queue:{i}:tg_attachment_id'
-            l1 = f'chat:{chat_id}:queue:{i + 1}:tg_attachment_id'
-            redis.set(k0, redis.get(k1) or '')
-            redis.set(l0, redis.get(l1) or '')
-        # The last element is now duplicated; delete it
-        redis.delete(f'chat:{chat_id}:queue:{queue_size}:text')
-        redis.delete(f'chat:{chat_id}:queue:{queue_size}:tg_attachment_id')
-
-        tweet_url = build_tweet_url(status)
-        logging.info(f'Tweeted: {tweet_url} for chat_id {chat_id}')
-        telegram_updater.bot.send_message(chat_id=chat_id, text=f'I just tweeted this: {tweet_url}\n'
-                                                                f'\n'
-                                                                f'Tweets in queue: {queue_size}')
-        if queue_size <= 0:
-            telegram_updater.bot.send_message(chat_id=chat_id, text="Your queue is now empty. I will not tweet "
-                                                                    "tomorrow if you won't give me new stuff!")
-        redis.set(f'chat:{chat_id}:queue_size', queue_size)
+        queue_size = dequeue_after_post(chat_id)
+    finally:
+        if failure == 'unauthorized':
+            # Until it is authorized again
+            unschedule_chat(chat_id)
+        else:
+            # Also if posting failed, so it is not retried every minute
+            schedule_chat(chat_id, after=now, settings=settings, retry_at=retry_at)
+
+    tweet_url = build_tweet_url(status)
+    logging.info(f'Tweeted: {tweet_url} for chat_id {chat_id}')
+    notifier.send(chat_id, f'I just tweeted this: {tweet_url}\n'
+                           f'\n'
+                           f'Tweets in queue: {queue_size}')
+    if queue_size <= 0:
+        notifier.send(chat_id, "Your queue is now empty. I will not tweet "
+                               "tomorrow if you won't give me new stuff!")
+
+
+def post_tweet(chat_id, tweet_text: str, tg_attachment_id: Optional[str]) -> tweepy.Status:
+    twitter = get_twitter_api(chat_id)
+    if not tg_attachment_id:
+        return post_status(twitter, tweet_text)
+    try:
+        # Usually, the attachment has already been prefetched
+        with media_cache.checkout(tg_attachment_id) as filename:
+            media_id = upload_media(twitter.auth, chat_id, tg_attachment_id, filename)
+    except (TelegramError, requests.RequestException) as e:
+        # Requests to twitter raise TweepErrors, so these were raised by the download. It is retried like a post
+        raise AttachmentDownloadError(f'Unable to download the attachment: {e}') from e
+    status = post_status(twitter, tweet_text, media_ids=[media_id])
+    forget_upload(chat_id, tg_attachment_id)
+    media_cache.discard(tg_attachment_id)
+    return status
+
+
+def handle_failure(chat_id, head, kind: str, e: tweepy.error.TweepError) -> Optional[datetime]:
+    """
+    Notifies the chat about a failed tweet if necessary. `kind` is the result of `classify_failure`.
+    Returns the time to retry the tweet at, if it should be retried before the next regular tweet time
+    """
+    tweet_text, tg_attachment_id = head
+    POSTS.inc(result='failure', reason=failure_reason(e))
+    logging.warning(f'Unable to tweet for chat {chat_id} ({"with" if tg_attachment_id else "without"} attachment, '
+                    f'{kind}). Reason: {e.reason}')
+    if kind == 'transient':
+        reset_delay = rate_limit_delay(chat_id, e)
+        attempt = count_failed_attempt(chat_id)
+        if attempt < MAX_POST_ATTEMPTS:
+            delay = max(retry_delay(attempt), reset_delay)
+            logging.info(f'Retrying tweet of chat {chat_id} in {delay:.0f} seconds (attempt {attempt + 1})')
+            return datetime.now(utc) + timedelta(seconds=delay)
+        report_failure(chat_id, f'{e.reason} (tried {attempt} times)', tweet_text, tg_attachment_id)
+        reset_failed_attempts(chat_id)
+    elif kind == 'duplicate':
+        # Also happens if a previous attempt was posted, but not removed from the queue
+        dequeue_after_post(chat_id)
+        if tg_attachment_id:
+            forget_upload(chat_id, tg_attachment_id)
+            media_cache.discard(tg_attachment_id)
+        notifier.send(chat_id, 'Twitter did not accept your daily tweet because you already tweeted the same '
+                               'text recently. I removed it from the queue:')
+        notifier.send(chat_id, tweet_text)
+    elif kind == 'unauthorized':
+        notifier.send(chat_id, f'{e.reason}\n'
+                               f'\n'
+                               f'Twitter does not let me tweet for you anymore, so I stopped tweeting. '
+                               f'Set me up again to continue: /start')
+    else:
+        report_failure(chat_id, e.reason, tweet_text, tg_attachment_id)
+        reset_failed_attempts(chat_id)
+    return None
+
+
+def report_failure(chat_id, reason: str, tweet_text: str, tg_attachment_id: Optional[str]):
+    notifier.send(chat_id, reason)
+    if tg_attachment_id:
+        notifier.send(chat_id, 'Sorry, I was unable to post your daily tweet. '
+                               'This is your tweet, and it contained one attachment:')
+    else:
+        notifier.send(chat_id, 'Sorry, I was unable to post your daily tweet. This is your tweet:')
+    notifier.send(chat_id, tweet_text)
+    notifier.send(chat_id, 'You may delete it from the queue: /delete_last')
+
+
+def handle_sigterm(signum, frame):
+    """Docker stops the container with SIGTERM, it shuts down like on Ctrl+C"""
+    raise KeyboardInterrupt
 
 
 if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    init_sentry()
     check_env_variables()
-    telegram_updater = get_telegram_updater()
-    FILE_STORAGE_PATH.mkdir(parents=True, exist_ok=True)
-    logging.info('Scheduled tweeting')
-    while True:
-        try:
-            # TODO: although we are using threads, we still get a slight drift
-            #       (each run gets executed after 60 seconds + a couple milliseconds)
-            #       we may therefore sometimes miss posting a tweet
-            run_threaded(loop)
-            sleep(60)
-        except KeyboardInterrupt:
-            logging.info('Shutting down')
-            sys.exit(0)
+    report_startup('imports', STARTED_AT)
+    telegram_bot = get_telegram_bot(con_pool_size=TWEET_WORKERS + 4)
+    media_cache.cleanup()
+    start_metrics_server()
+    # Queues of the old layout would look empty to the scheduler. Does nothing once all of them were migrated
+    migrated_queues = migrate_legacy_queues()
+    if migrated_queues:
+        logging.info(f'Migrated the queues of {migrated_queues} chats to the list layout')
+    if not get_redis().exists(SCHEDULE_KEY):
+        logging.info(f'Building schedule index, scheduled {backfill_schedule()} chats')
+    threading.Thread(target=heartbeat, name='heartbeat', daemon=True).start()
+    notifier.start()
+    logging.info(f'Scheduled tweeting as instance {INSTANCE_ID}')
+    try:
+        run_scheduler(STARTED_AT)
+    except KeyboardInterrupt:
+        logging.info('Shutting down')
+        # Hand over the chats immediately instead of waiting for the heartbeat to time out
+        get_redis().zrem(INSTANCES_KEY, INSTANCE_ID)
+        if not notifier.flush(timeout=10):
+            logging.warning('Some messages could not be sent before shutting down')
+        sys.exit(0)